@@ -1,70 +1,42 @@
 #!/usr/bin/env python3
 
 import argparse
-
-import gi
-gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk
-
-from Config import Settings, PreferenceWidget
-from Data import DB
-from Quizzer import Quizzer
-from StatWidgets import StringStats
-from TextManager import TextManager
-from Performance import PerformanceHistory
-from Lesson import LessonGenerator
-from Database import DatabaseWidget
-
-class App(Gtk.Window):
-    def __init__(self):
-        Gtk.Window.__init__(self)
-        self.set_title("Amphetype")
-
-        notebook = Gtk.Notebook()
-        self.add(notebook)
-
-        quiz = Quizzer()
-        notebook.append_page(quiz, Gtk.Label.new("Typer"))
-
-        textm = TextManager()
-        notebook.append_page(textm, Gtk.Label.new("Sources"))
-        quiz.connect("want-text", lambda _: textm.next_text())
-        textm.connect("set-text", lambda _, *text: quiz.set_target(text))
-        textm.connect("go-to-text", lambda _: notebook.set_current_page(0))
-
-        perf = PerformanceHistory()
-        notebook.append_page(perf, Gtk.Label.new("Performance"))
-        textm.connect("refresh-sources", lambda _: perf.refresh_sources())
-        quiz.connect("stats-changed", lambda _: perf.update_data())
-        perf.connect("set-text", lambda *text: quiz.set_target(text))
-        perf.connect("go-to-text", lambda _: notebook.set_current_page(0))
-
-        stats = StringStats()
-        notebook.append_page(stats, Gtk.Label.new("Analysis"))
-        # stats.connect("lesson-strings", lambda _: notebook.set_current_page(4))
-
-        lgen = LessonGenerator()
-        notebook.append_page(lgen, Gtk.Label.new("Lesson Generator"))
-        # stats.connect("lesson-strings", lgen.add_strings)
-        lgen.connect("new-lessons", lambda _, _2: notebook.set_current_page(1))
-        lgen.connect("new-lessons", textm.add_texts)
-        # quiz.connect("want-review", ...)
-        lgen.connect("new-review", textm.new_review)
-
-        dbase = DatabaseWidget()
-        notebook.append_page(dbase, Gtk.Label.new("Database"))
-
-        pref = PreferenceWidget()
-        notebook.append_page(pref, Gtk.Label.new("Preferences"))
-
-        textm.next_text()
+import time
+STARTED = time.perf_counter() # for the startup time report
 
 def main():
+    parser = argparse.ArgumentParser(description="Typing tutor with detailed statistics")
+    parser.add_argument("--import", dest="import_paths", nargs="+", metavar="PATH",
+                        help="import text files, directories or glob patterns and exit")
+    args = parser.parse_args()
+
+    # Loaded here rather than at the top, as the worker processes of
+    # Text.mine_files run this script again and only need Miner
+    import gi
+    gi.require_version("Gtk", "3.0")
+    from gi.repository import Gtk, GLib
+
+    from Config import Settings
+    from Data import DB, WRITER
+    from TextManager import import_files
+    from App import App
+
+    if args.import_paths:
+        import_files(args.import_paths)
+        return
+
     app = App()
     app.show_all()
     app.connect("destroy", Gtk.main_quit)
+    print(f"Window built after {time.perf_counter() - STARTED:.3f}s")
+    GLib.idle_add(lambda: print(f"First text shown after {time.perf_counter() - STARTED:.3f}s"))
     Gtk.main()
+    # the writer may be waiting for the main connection to let go of the database
     DB.commit()
+    WRITER.flush()
+    Settings.commit()
+    if Settings.get("profile_queries"):
+        print(DB.profile_report(explain=True))
 
 if __name__ == "__main__":
     main()
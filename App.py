@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import gi
+gi.require_version("Gtk", "3.0")
+from gi.repository import Gtk
+
+import GtkUtil
+from Config import PreferenceWidget
+from Quizzer import Quizzer
+from StatWidgets import StringStats
+from TextManager import TextManager
+from Performance import PerformanceHistory
+from Lesson import LessonGenerator
+from Database import DatabaseWidget
+
+class App(Gtk.Window):
+    def __init__(self):
+        Gtk.Window.__init__(self)
+        self.set_title("Amphetype")
+
+        notebook = Gtk.Notebook()
+        self.add(notebook)
+
+        quiz = Quizzer()
+        notebook.append_page(quiz, Gtk.Label.new("Typer"))
+
+        textm = TextManager()
+        notebook.append_page(textm, Gtk.Label.new("Sources"))
+        quiz.connect("want-text", lambda _: textm.next_text())
+        textm.connect("set-text", lambda _, *text: quiz.set_target(text))
+        textm.connect("go-to-text", lambda _: notebook.set_current_page(0))
+
+        # the other tabs are only built when they are first shown
+        def performance():
+            perf = PerformanceHistory()
+            textm.connect("refresh-sources", lambda _: perf.refresh_sources())
+            quiz.connect("stats-changed", lambda _: perf.update_data())
+            perf.connect("set-text", lambda *text: quiz.set_target(text))
+            perf.connect("go-to-text", lambda _: notebook.set_current_page(0))
+            return perf
+        notebook.append_page(GtkUtil.LazyPage(performance), Gtk.Label.new("Performance"))
+
+        notebook.append_page(GtkUtil.LazyPage(StringStats), Gtk.Label.new("Analysis"))
+        # stats.connect("lesson-strings", lambda _: notebook.set_current_page(4))
+
+        def generator():
+            lgen = LessonGenerator()
+            # stats.connect("lesson-strings", lgen.add_strings)
+            lgen.connect("new-lessons", lambda _, _2: notebook.set_current_page(1))
+            lgen.connect("new-lessons", textm.add_texts)
+            # quiz.connect("want-review", ...)
+            lgen.connect("new-review", textm.new_review)
+            return lgen
+        notebook.append_page(GtkUtil.LazyPage(generator), Gtk.Label.new("Lesson Generator"))
+
+        notebook.append_page(GtkUtil.LazyPage(DatabaseWidget), Gtk.Label.new("Database"))
+        notebook.append_page(GtkUtil.LazyPage(PreferenceWidget), Gtk.Label.new("Preferences"))
+
+        textm.next_text()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import sys
+import os
 import os.path
 import pickle
 import json
@@ -41,8 +42,13 @@ class AmphSettings(GObject.Object):
         "chrono_x": False,
         "dampen_graph": False,
 
+        "approx_median": False,
+        "log_keystrokes": False,
+        "profile_queries": False,
+
         "minutes_in_sitting": 60.0,
         "dampen_average": 10,
+        "dampen_method": "a",
         "def_group_by": 10,
 
         "use_lesson_stats": False,
@@ -80,10 +86,15 @@ class AmphSettings(GObject.Object):
         "change": (GObject.SignalFlags.RUN_FIRST, None, ()),
         **{("change_" + key): (GObject.SignalFlags.RUN_FIRST, None, ()) for key in defaults}
         }
+    commit_delay = 1000 # milliseconds
+
 
     def __init__(self):
         GObject.Object.__init__(self)
         self.settings = {}
+        self.commit_source_ = None # pending write
+        self.changed_ = set() # keys whose change signals are pending
+        self.any_change_ = [] # (keys, callback) of on_any_change
         try:
             with open(config_path()) as cfg:
                 self.settings = json.load(cfg)
@@ -121,29 +132,61 @@ class AmphSettings(GObject.Object):
 
     def commit(self):
         """
-        Save the config to disk
+        Save pending changes to disk now instead of once the write delay has passed
+        """
+        if self.commit_source_ is None:
+            return
+        GLib.source_remove(self.commit_source_)
+        self.save()
+
+    def save(self):
+        """
+        Save the config to disk, replacing the old file only once the new one is written
         """
+        self.commit_source_ = None
+        path = config_path()
         try:
-            with open(config_path(), "w") as cfg:
+            with open(path + ".tmp", "w") as cfg:
                 json.dump(self.settings, cfg)
+                cfg.flush()
+                os.fsync(cfg.fileno())
+            os.replace(path + ".tmp", path)
         except IOError as err:
             print("Error saving config\n", err)
+        return False
 
     def set(self, key, value):
         """
-        Set persistent configuration value
+        Set persistent configuration value. The config is written after commit_delay
+        and the change signals are emitted once the main loop is idle, so changes made
+        together are saved and signalled together.
         """
         if self.get(key) == value:
             return # nothing changed
         print("set", key, value)
         self.settings[key] = value
-        self.commit()
+        if self.commit_source_ is None:
+            self.commit_source_ = GLib.timeout_add(self.commit_delay, self.save)
+        if not self.changed_:
+            GLib.idle_add(self.emit_changes)
+        self.changed_.add(key)
+
+    def emit_changes(self):
+        """
+        Emit the change signals for the keys set since the last call, and call each
+        on_any_change callback once if any of its keys are among them
+        """
+        keys, self.changed_ = self.changed_, set()
         self.emit("change")
-        self.emit("change_" + key)
+        for key in sorted(keys):
+            self.emit("change_" + key)
+        for configs, callback in self.any_change_:
+            if not configs.isdisjoint(keys):
+                callback()
+        return False
 
     def on_any_change(self, configs, callback):
-        for key in configs:
-            self.connect("change_" + key, lambda *_: callback())
+        self.any_change_.append((frozenset(configs), callback))
 
 Settings = AmphSettings()
 
@@ -171,7 +214,7 @@ class SettingsEdit(Gtk.Entry):
 
         Gtk.Entry.__init__(self, text=self.fmt(val))
         Settings.connect("change_" + key,
-                         lambda: self.set_text(self.fmt(Settings.get(key))))
+                         lambda *_: self.set_text(self.fmt(Settings.get(key))))
         self.connect("activate",
                      lambda _: Settings.set(key, typ(self.get_text())))
 
@@ -217,6 +260,12 @@ class PreferenceWidget(GtkUtil.AmphBoxLayout):
             SettingsCheckBox("use_lesson_stats",
                              "Save key/trigram/word statistics from generated lessons."),
             SettingsCheckBox("req_space", "Make SPACE mandatory before each session"),
+            SettingsCheckBox("log_keystrokes",
+                             "Keep a log of every key press with each result."),
+            SettingsCheckBox("approx_median",
+                             "Estimate medians approximately (faster on very large databases)."),
+            SettingsCheckBox("profile_queries",
+                             "Record the time taken by database queries (see the Database tab)."),
             0,
             ["Correct Input", SettingsColor("quiz_right_fg", "Foreground"),
              SettingsColor("quiz_right_bg", "Background")],
@@ -228,13 +277,15 @@ class PreferenceWidget(GtkUtil.AmphBoxLayout):
             ["Try to limit texts and lessons to between", SettingsEdit("min_chars"),
              "and", SettingsEdit("max_chars"), "characters."],
             ["When selecting easy/difficult texts, scan a sample of",
-             SettingsEdit("num_rand"), "texts."],
+             SettingsEdit("num_rand"), "texts (0 for all texts)."],
             ["When grouping by sitting on the Performance tab, consider results more than",
              SettingsEdit("minutes_in_sitting"), "minutes away to be part of a different sitting."],
             ["Group by", SettingsEdit("def_group_by"),
              "results when displaying last scores and showing last results on the Typer tab."],
-            ["When smoothing out the graph, display a running average of",
-             SettingsEdit("dampen_average"), "values"],
+            ["When smoothing out the graph, display a running",
+             SettingsCombo("dampen_method", [("a", "average"), ("e", "exponential average"),
+                                             ("m", "median")]),
+             "of", SettingsEdit("dampen_average"), "values"],
             ]
         GtkUtil.AmphBoxLayout.__init__(self, layout)
         self.set_homogeneous(True)
@@ -1,75 +1,156 @@
 #!/usr/bin/env python3
 
 import bisect
+import collections
+import copy
+import os
 import sqlite3
+import random
 import re
+import threading
+import time
+import queue
+import traceback
+import urllib.parse
+from array import array
+
+from gi.repository import GLib
 
 import GtkUtil
 from Config import Settings, database_path
 
-def trimmed_average(total, series):
-    s_val = 0.0
-    n_val = 0
-
-    start = 0
-    cutoff = total // 3
-    while cutoff > 0:
-        cutoff -= series[start][1]
-        start += 1
-    if cutoff < 0:
-        s_val += -cutoff * series[start-1][0]
-        n_val += -cutoff
-
-    end = len(series)-1
-    cutoff = total // 3
-    while cutoff > 0:
-        cutoff -= series[end][1]
-        end -= 1
-    if cutoff < 0:
-        s_val += -cutoff * series[end+1][0]
-        n_val += -cutoff
-
-    while start <= end:
-        s_val += series[start][1] * series[start][0]
-        n_val += series[start][1]
-        start += 1
-
-    return s_val/n_val
-
-class Statistic(list):
+def select_kth(values, k):
+    """
+    Return the k-th smallest (0-based) of values, in expected linear time
+    """
+    while True:
+        pivot = values[random.randrange(len(values))]
+        lower = [x for x in values if x < pivot]
+        if k < len(lower):
+            values = lower
+            continue
+        k -= len(lower)
+        upper = [x for x in values if x > pivot]
+        equal = len(values) - len(lower) - len(upper)
+        if k < equal:
+            return pivot
+        k -= equal
+        values = upper
+
+def median(values):
+    length = len(values)
+    if length == 0:
+        return None
+    if length & 1:
+        return select_kth(values, length // 2)
+    return (select_kth(values, length//2) + select_kth(values, length//2 - 1))/2.0
+
+def pack_values(*values):
+    """
+    Pack floats into a blob, as stored in statistic_rollup
+    """
+    return array("d", values).tobytes()
+
+def unpack_values(blob):
+    values = array("d")
+    values.frombytes(blob)
+    return values
+
+class PackAggregate():
     def __init__(self):
-        super(Statistic, self).__init__()
-        self.flawed_ = 0
+        self.values = array("d")
 
-    def append(self, x, flawed=False):
-        bisect.insort(self, x)
-        if flawed:
-            self.flawed_ += 1
+    def step(self, val):
+        if val is not None:
+            self.values.append(val)
 
-    def __cmp__(self, other):
-        cmp = lambda a, b: (a > b) - (b > a)
-        return cmp(self.median(), other.median())
+    def finalize(self):
+        return self.values.tobytes()
 
-    def measurement(self):
-        return trimmed_average(len(self), [(x, 1) for x in self])
+class MedianAggregate():
+    """
+    Exact median, collecting values into a compact array. Accepts blobs of
+    packed values as well as single values.
+    """
+    def __init__(self):
+        self.values = array("d")
 
-    def median(self):
-        length = len(self)
-        if length == 0:
-            return None
-        if length & 1:
-            return self[length // 2]
-        return (self[length//2] + self[length//2-1])/2.0
+    def step(self, val):
+        if isinstance(val, bytes):
+            self.values.frombytes(val)
+        elif val is not None:
+            self.values.append(val)
+
+    def finalize(self):
+        return median(self.values)
+
+class ApproxMedianAggregate():
+    """
+    Median that is exact for small groups and switches to a streaming P²
+    estimate (Jain & Chlamtac) for larger ones, which only keeps five markers
+    regardless of the number of values.
+    """
+    exact_limit = 4096
 
-    def flawed(self):
-        return self.flawed_
+    def __init__(self):
+        self.values = array("d")
+        self.heights = None
+        self.positions = None
+        self.desired = None
+
+    def start_estimate(self):
+        values = sorted(self.values)
+        last = len(values) - 1
+        self.desired = [0.0, last/4, last/2, 3*last/4, float(last)]
+        self.positions = [round(x) for x in self.desired]
+        self.heights = [values[x] for x in self.positions]
+        self.values = None
 
-class MedianAggregate(Statistic):
     def step(self, val):
-        self.append(val)
+        if isinstance(val, bytes):
+            for item in unpack_values(val):
+                self.step(item)
+            return
+        if val is None:
+            return
+        if self.heights is None:
+            self.values.append(val)
+            if len(self.values) > self.exact_limit:
+                self.start_estimate()
+            return
+
+        q = self.heights
+        if val < q[0]:
+            q[0] = val
+            cell = 0
+        elif val >= q[4]:
+            q[4] = val
+            cell = 3
+        else:
+            cell = bisect.bisect_right(q, val) - 1
+
+        pos = self.positions
+        for i in range(cell + 1, 5):
+            pos[i] += 1
+        for i, inc in enumerate((0.0, 0.25, 0.5, 0.75, 1.0)):
+            self.desired[i] += inc
+
+        for i in (1, 2, 3):
+            delta = self.desired[i] - pos[i]
+            if (delta >= 1 and pos[i+1] - pos[i] > 1) or (delta <= -1 and pos[i-1] - pos[i] < -1):
+                d = 1 if delta > 0 else -1
+                est = q[i] + d / (pos[i+1] - pos[i-1]) * (
+                    (pos[i] - pos[i-1] + d) * (q[i+1] - q[i]) / (pos[i+1] - pos[i])
+                    + (pos[i+1] - pos[i] - d) * (q[i] - q[i-1]) / (pos[i] - pos[i-1]))
+                if not q[i-1] < est < q[i+1]:
+                    est = q[i] + d * (q[i+d] - q[i]) / (pos[i+d] - pos[i])
+                q[i] = est
+                pos[i] += d
 
     def finalize(self):
-        return self.median()
+        if self.heights is None:
+            return median(self.values)
+        return self.heights[2]
 
 class MeanAggregate():
     def __init__(self):
@@ -94,39 +175,257 @@ class FirstAggregate():
     def finalize(self):
         return self.val
 
+# Fills statistic_rollup: one row per day, type and item, with time and viscosity
+# as blobs of packed values so that medians over several days stay exact
+ROLLUP_SQL = """
+insert into statistic_rollup (day, type, data, time, viscosity, count, mistakes)
+    select cast(w/86400 as int),type,data,agg_pack(time),agg_pack(viscosity),sum(count),sum(mistakes)
+    from statistic {where} group by 1, 2, 3"""
+
+# Schema migrations, applied in order on top of the tables created by
+# AmphDatabase.initialise. PRAGMA user_version holds how many have been applied.
+MIGRATIONS = [
+    # 1: indexes for the analysis, text selection and history queries
+    """
+create index statistic_type_w on statistic (type, w, data);
+create index result_w on result (w);
+create index result_text_id on result (text_id);
+create index text_source_disabled on text (source, disabled);
+    """,
+    # 2: per-day rollup of statistic, see AmphDatabase.statistic_source
+    """
+create table statistic_rollup (day integer, type integer, data text, time blob, viscosity blob,
+    count integer, mistakes integer, primary key (type, day, data));
+    """ + ROLLUP_SQL.format(where="") + ";",
+    # 3: raw key presses of results, see Typer.get_keystrokes
+    """
+create table keystroke (result integer primary key, times blob, keys blob);
+    """,
+    # 4: row counts kept up to date by triggers, see AmphDatabase.counters
+    """
+create table counter (name text primary key, value integer not null) without rowid;
+insert into counter (name, value) values
+    ('texts', (select count(*) from text)),
+    ('results', (select count(*) from result)),
+    ('statistic_0', (select count(*) from statistic where type = 0)),
+    ('statistic_1', (select count(*) from statistic where type = 1)),
+    ('statistic_2', (select count(*) from statistic where type = 2)),
+    ('typed_0', (select coalesce(sum(count), 0) from statistic where type = 0)),
+    ('typed_1', (select coalesce(sum(count), 0) from statistic where type = 1)),
+    ('typed_2', (select coalesce(sum(count), 0) from statistic where type = 2));
+create trigger counter_text_insert after insert on text begin
+    update counter set value = value + 1 where name = 'texts';
+end;
+create trigger counter_text_delete after delete on text begin
+    update counter set value = value - 1 where name = 'texts';
+end;
+create trigger counter_result_insert after insert on result begin
+    update counter set value = value + 1 where name = 'results';
+end;
+create trigger counter_result_delete after delete on result begin
+    update counter set value = value - 1 where name = 'results';
+end;
+create trigger counter_statistic_insert after insert on statistic begin
+    update counter set value = value + 1 where name = 'statistic_' || new.type;
+    update counter set value = value + new.count where name = 'typed_' || new.type;
+end;
+create trigger counter_statistic_delete after delete on statistic begin
+    update counter set value = value - 1 where name = 'statistic_' || old.type;
+    update counter set value = value - old.count where name = 'typed_' || old.type;
+end;
+    """,
+    ]
+
+
+class QueryStats():
+    """
+    Calls, rows and time spent of one statement, for AmphDatabase.profile_report
+    """
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.args = ()
+
+    def add(self, seconds, rows, args):
+        self.calls += 1
+        self.rows += rows
+        self.total += seconds
+        self.worst = max(self.worst, seconds)
+        self.args = args
+
+class QueryProfile():
+    """
+    QueryStats of the statements run on all connections, recorded while
+    profile_queries is set
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.restart()
+        Settings.connect("change_profile_queries", lambda *_: self.restart())
+
+    def restart(self):
+        """
+        Start recording if profile_queries is set, discarding what was recorded
+        """
+        with self.lock:
+            self.enabled = Settings.get("profile_queries")
+            self.queries = collections.defaultdict(QueryStats)
+
+    def add(self, sql, seconds, rows, args):
+        with self.lock:
+            self.queries[sql].add(seconds, rows, args)
+
+    def slowest(self, limit):
+        """
+        (sql, QueryStats) of the statements taking the most time in total
+        """
+        with self.lock:
+            queries = [(sql, copy.copy(stats)) for sql, stats in self.queries.items()]
+        return sorted(queries, key=lambda item: item[1].total, reverse=True)[:limit]
+
+PROFILE = QueryProfile()
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    Cursor that adds each statement to PROFILE once its rows have all been read
+    (or the cursor is discarded), so the time includes fetching them
+    """
+    start_ = None
+
+    def execute(self, sql, args=()):
+        self.finish()
+        self.sql_, self.args_, self.rows_ = sql, args, 0
+        self.start_ = time.perf_counter()
+        try:
+            super(ProfiledCursor, self).execute(sql, args)
+        except sqlite3.Error:
+            self.start_ = None
+            raise
+        if self.description is None: # no rows to read
+            self.rows_ = max(self.rowcount, 0)
+            self.finish()
+        return self
+
+    def executemany(self, sql, seq):
+        self.finish()
+        last = [()] # the arguments of the last row, for EXPLAIN QUERY PLAN
+
+        def remember(seq):
+            for args in seq:
+                last[0] = args
+                yield args
+
+        self.sql_, self.rows_ = sql, 0
+        self.start_ = time.perf_counter()
+        try:
+            super(ProfiledCursor, self).executemany(sql, remember(seq))
+        except sqlite3.Error:
+            self.start_ = None
+            raise
+        self.args_ = last[0]
+        self.rows_ = max(self.rowcount, 0)
+        self.finish()
+        return self
+
+    def __next__(self):
+        try:
+            row = super(ProfiledCursor, self).__next__()
+        except StopIteration:
+            self.finish()
+            raise
+        self.rows_ += 1
+        return row
+
+    def fetchone(self):
+        row = super(ProfiledCursor, self).fetchone()
+        if row is None:
+            self.finish()
+        else:
+            self.rows_ += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super(ProfiledCursor, self).fetchmany(self.arraysize if size is None else size)
+        self.rows_ += len(rows)
+        if not rows:
+            self.finish()
+        return rows
+
+    def fetchall(self):
+        rows = super(ProfiledCursor, self).fetchall()
+        self.rows_ += len(rows)
+        self.finish()
+        return rows
+
+    def close(self):
+        self.finish()
+        super(ProfiledCursor, self).close()
+
+    def __del__(self):
+        self.finish()
+
+    def finish(self):
+        if self.start_ is not None:
+            PROFILE.add(self.sql_, time.perf_counter() - self.start_, self.rows_, self.args_)
+            self.start_ = None
+
+# set on every connection by connect()
+PRAGMAS = """
+pragma synchronous = normal;
+pragma cache_size = -16000;
+pragma mmap_size = 268435456;
+pragma temp_store = memory;
+"""
+
+# prepared statements kept per connection, keyed by their SQL
+STATEMENT_CACHE = 512
 
 class AmphDatabase(sqlite3.Connection):
-    def __init__(self, *args):
-        super(AmphDatabase, self).__init__(*args)
+    def __init__(self, *args, **kwargs):
+        super(AmphDatabase, self).__init__(*args, **kwargs)
 
         self.set_regex("")
-        self.reset_counter()
-        self.lasttime_ = 0.0 # to suppress warning
-        self.reset_time_group()
-        self.create_function("counter", 0, self.counter)
         self.create_function("regex_match", 1, self.match)
         self.create_function("abbreviate", 2, self.abbreviate)
-        self.create_function("time_group", 2, self.time_group)
-        self.create_aggregate("agg_median", 1, MedianAggregate)
+        self.register_median()
+        self.recent_ = None
         self.create_aggregate("agg_mean", 2, MeanAggregate)
         self.create_aggregate("agg_first", 1, FirstAggregate)
+        self.create_aggregate("agg_pack", 1, PackAggregate)
+        self.create_function("blob_concat", 2, lambda x, y: x + y)
+        self.create_function("text_time", 1, self.text_time)
         #self.create_aggregate("agg_trimavg", 2, TrimmedAverarge)
         self.create_function("ifelse", 3, lambda x, y, z: y if x is not None else z)
-
+        self.trigram_times_ = {}
+        self.trigram_expect_ = None
+        # disconnected again by close()
+        self.handlers_ = [
+            Settings.connect("change_approx_median", lambda *_: self.register_median()),
+            ]
+
+    def close(self):
+        for handler in self.handlers_:
+            Settings.disconnect(handler)
+        self.handlers_ = []
+        super(AmphDatabase, self).close()
+
+    def setup(self):
+        """
+        Create or migrate the schema, for connections that may write
+        """
         try:
             self.fetchall("select * from result,source,statistic,text,mistake limit 1")
         except sqlite3.Error:
             self.initialise()
+        self.migrate()
 
-    def reset_time_group(self):
-        self.lasttime_ = 0.0
-        self.timecnt_ = 0
-
-    def time_group(self, interval, ltime):
-        if abs(ltime - self.lasttime_) >= interval:
-            self.timecnt_ += 1
-        self.lasttime_ = ltime
-        return self.timecnt_
+    def register_median(self):
+        if Settings.get("approx_median"):
+            self.create_aggregate("agg_median", 1, ApproxMedianAggregate)
+        else:
+            self.create_aggregate("agg_median", 1, MedianAggregate)
 
     def set_regex(self, pattern):
         self.regex_ = re.compile(pattern)
@@ -141,13 +440,6 @@ class AmphDatabase(sqlite3.Connection):
             return 1
         return 0
 
-    def counter(self):
-        self._count += 1
-        return self._count
-
-    def reset_counter(self):
-        self._count = -1
-
     def initialise(self):
         self.executescript("""
 create table source (name text, disabled integer, discount integer);
@@ -161,8 +453,47 @@ create view text_source as
         """)
         self.commit()
 
-    def fetchall(self, *args):
-        return self.execute(*args).fetchall()
+    def migrate(self):
+        """
+        Bring the schema up to date, one transaction per migration
+        """
+        version = self.fetchone("pragma user_version", (0, ))[0]
+        for idx, script in enumerate(MIGRATIONS[version:], version + 1):
+            print("migrating database to version", idx)
+            self.executescript(f"begin;\n{script}\npragma user_version = {idx};\ncommit;")
+
+    def execute(self, sql, args=()):
+        if not PROFILE.enabled:
+            return super(AmphDatabase, self).execute(sql, args)
+        return self.cursor(ProfiledCursor).execute(sql, args)
+
+    def executemany(self, sql, seq):
+        if not PROFILE.enabled:
+            return super(AmphDatabase, self).executemany(sql, seq)
+        return self.cursor(ProfiledCursor).executemany(sql, seq)
+
+    def fetchall(self, sql, args=()):
+        return self.execute(sql, args).fetchall()
+
+    def profile_report(self, limit=20, explain=False):
+        """
+        The statements taking the most time in total on any connection since
+        profiling started, with their query plans (for their last arguments) if
+        explain is set
+        """
+        lines = []
+        for sql, stats in PROFILE.slowest(limit):
+            lines.append(f"{1000*stats.total:9.1f}ms total {stats.calls:6} calls "
+                         f"{1000*stats.worst:8.1f}ms max {stats.rows:8} rows  "
+                         + " ".join(sql.split())[:120])
+            if explain:
+                try:
+                    plan = super(AmphDatabase, self).execute(
+                        "explain query plan " + sql, stats.args).fetchall()
+                except sqlite3.Error as err:
+                    plan = [(0, 0, 0, str(err))]
+                lines.extend("    " + row[3] for row in plan)
+        return "\n".join(lines)
 
     def fetchone(self, sql, default, *args):
         row = self.execute(sql, *args).fetchone()
@@ -170,6 +501,218 @@ create view text_source as
             return default
         return row
 
+    def add_statistics(self, rows):
+        """
+        Insert (time, viscosity, w, count, mistakes, type, data) rows into statistic,
+        keeping statistic_rollup up to date
+        """
+        rows = list(rows)
+        self.executemany("""insert into statistic (time,viscosity,w,count,mistakes,type,data)
+            values (?,?,?,?,?,?,?)""", rows)
+        self.executemany("""
+            insert into statistic_rollup (time,viscosity,day,count,mistakes,type,data)
+                values (?,?,cast(?/86400 as int),?,?,?,?)
+            on conflict (type, day, data) do update set
+                time = blob_concat(time, excluded.time),
+                viscosity = blob_concat(viscosity, excluded.viscosity),
+                count = count + excluded.count,
+                mistakes = mistakes + excluded.mistakes""",
+                         [(pack_values(time), pack_values(visc), *rest)
+                          for time, visc, *rest in rows])
+
+    def add_texts(self, source, texts, disabled=None):
+        """
+        Insert (id, text) pairs into a source, skipping texts that are already present.
+        Returns the number of texts added, which unlike total_changes leaves out the
+        rows changed by triggers.
+        """
+        return self.executemany(
+            "insert or ignore into text (id,text,source,disabled) values (?,?,?,?)",
+            ((text_id, text, source, disabled) for text_id, text in texts)).rowcount
+
+    def set_trigram_times(self, times):
+        """
+        Set the typing time of each trigram used by text_time(), trigrams without a
+        time taking the upper quartile
+        """
+        self.trigram_times_ = times
+        vals = sorted(times.values(), reverse=True)
+        self.trigram_expect_ = vals[len(vals) // 4] if vals else None
+
+    def text_scores(self, times):
+        """
+        Ids of all texts ordered by text_time() for the given trigram times, fastest
+        first
+        """
+        self.set_trigram_times(times)
+        return [text_id for text_id, in self.fetchall("""
+            select id from (select id,text_time(text) as time from text)
+            where time is not null order by time""")]
+
+    def add_recent_result(self, when, wpm, accuracy):
+        """
+        Add a new result to the rolling window of the last def_group_by results and
+        return its median wpm and accuracy (in percent). Call before the result
+        itself is stored. The window keeps the results added to it, so those the
+        writer hasn't stored yet still count. Older results are read from the result
+        table when the window is first used or grows, once the writer has stored
+        everything submitted to it.
+        """
+        group = max(Settings.get("def_group_by"), 1)
+        if self.recent_ is None or self.recent_.maxlen != group:
+            self.recent_ = collections.deque(self.recent_ or (), group)
+        if len(self.recent_) < group - 1:
+            # the writer may be waiting for this connection to commit
+            self.commit()
+            WRITER.flush()
+            oldest = self.recent_[0][0] if self.recent_ else float("inf")
+            self.recent_.extendleft(self.fetchall(
+                "select w,wpm,100.0*accuracy from result where w < ? order by w desc limit ?",
+                (oldest, group - 1 - len(self.recent_))))
+        self.recent_.append((when, wpm, 100.0*accuracy))
+        return (median([x[1] for x in self.recent_]), median([x[2] for x in self.recent_]))
+
+    def text_time(self, text):
+        """
+        Estimated time per character of text, from the times of its trigrams
+        """
+        if self.trigram_expect_ is None or len(text) < 3:
+            return None
+        times = self.trigram_times_
+        expect = self.trigram_expect_
+        total = 0.0
+        for i in range(len(text) - 2):
+            total += times.get(text[i:i+3], expect)
+        return total / (len(text) - 2)
+
+    def rebuild_rollup(self):
+        """
+        Recompute statistic_rollup from scratch
+        """
+        self.execute("delete from statistic_rollup")
+        self.execute(ROLLUP_SQL.format(where=""))
+
+    def compact(self, tiers, progress=lambda fraction: None):
+        """
+        Replace the statistic and mistake rows older than the cutoff of each of the
+        (cutoff, binsize) tiers with one row per binsize seconds. Each row belongs to
+        the tier with the earliest cutoff at or after it. Meant to run in a single
+        transaction, so the originals, their replacements and statistic_rollup are
+        changed together. Returns the number of rows removed.
+        """
+        tiers = sorted(tiers)
+        if not tiers:
+            return 0
+        steps = 2 * len(tiers) + 2
+        self.execute("create temp table if not exists compact_statistic as select * from statistic where 0")
+        self.execute("create temp table if not exists compact_mistake as select * from mistake where 0")
+        self.execute("delete from temp.compact_statistic")
+        self.execute("delete from temp.compact_mistake")
+
+        low = float("-inf")
+        for idx, (cutoff, binsize) in enumerate(tiers):
+            self.execute("""
+                insert into temp.compact_statistic (time,viscosity,w,count,mistakes,type,data)
+                select agg_mean(time, count),agg_median(viscosity),avg(w),sum(count),
+                    sum(mistakes),type,data
+                from statistic where w > ? and w <= ?
+                group by data, type, cast(w/? as int)""", (low, cutoff, binsize))
+            progress((2 * idx + 1) / steps)
+            self.execute("""
+                insert into temp.compact_mistake (w,target,mistake,count)
+                select avg(w),target,mistake,sum(count)
+                from mistake where w > ? and w <= ?
+                group by target, mistake, cast(w/? as int)""", (low, cutoff, binsize))
+            progress((2 * idx + 2) / steps)
+            low = cutoff
+
+        removed = self.execute("delete from statistic where w <= ?", (low, )).rowcount
+        removed += self.execute("delete from mistake where w <= ?", (low, )).rowcount
+        removed -= self.execute("insert into statistic select * from temp.compact_statistic").rowcount
+        removed -= self.execute("insert into mistake select * from temp.compact_mistake").rowcount
+        progress((steps - 1) / steps)
+
+        # replaced rows keep to their tier, but not to their day
+        day = int(low // 86400)
+        self.execute("delete from statistic_rollup where day <= ?", (day, ))
+        self.execute(ROLLUP_SQL.format(where="where w < ?"), ((day + 1) * 86400, ))
+        self.execute("delete from temp.compact_statistic")
+        self.execute("delete from temp.compact_mistake")
+        progress(1.0)
+        return removed
+
+    def counters(self):
+        """
+        Row counts of text, result and statistic (statistic_<type>) and the number of
+        keys, trigrams and words typed (typed_<type>), as kept by triggers
+        """
+        return dict(self.fetchall("select name,value from counter"))
+
+    def table_sizes(self):
+        """
+        (name, bytes) of each table and index, largest first, or None if SQLite was
+        built without the dbstat table
+        """
+        try:
+            return self.fetchall("""select name,pgsize from dbstat where aggregate = 1
+                order by pgsize desc""")
+        except sqlite3.OperationalError:
+            return None
+
+    def size(self):
+        """
+        Bytes taken on disk by the database file and its write-ahead log
+        """
+        dbfile = self.fetchone("pragma database_list", (0, "main", ""))[2]
+        if not dbfile: # in memory
+            return self.fetchone("pragma page_count", (0, ))[0] * self.fetchone("pragma page_size", (0, ))[0]
+        return sum(os.path.getsize(name) for name in (dbfile, dbfile + "-wal")
+                   if os.path.exists(name))
+
+    def reclaim(self):
+        """
+        Give the free pages of the database back to the filesystem. The first time
+        this switches the database to incremental auto_vacuum, which takes a full
+        VACUUM; after that only the free pages are truncated. Either way the pages
+        pass through the write-ahead log, which is checkpointed and truncated
+        afterwards. Can't run inside a transaction.
+        """
+        if self.fetchone("pragma auto_vacuum", (0, ))[0] == 2: # incremental
+            self.fetchall("pragma incremental_vacuum")
+        else:
+            self.execute("pragma auto_vacuum = incremental")
+            self.execute("vacuum")
+        self.fetchall("pragma wal_checkpoint(truncate)")
+
+    def statistic_source(self, kind, since):
+        """
+        SQL and arguments for a (data, time, viscosity, count, mistakes) row source
+        equivalent to the statistics of the given type with w >= since. Whole days
+        are read from statistic_rollup and only the first, partial day from statistic
+        itself. time and viscosity may be blobs of packed values, which agg_median
+        understands.
+        """
+        sql = """
+            select data,time,viscosity,count,mistakes from statistic_rollup
+                where type = ? and day > cast(? / 86400 as int)
+            union all
+            select data,time,viscosity,count,mistakes from statistic
+                where type = ? and w >= ? and cast(w/86400 as int) = cast(? / 86400 as int)"""
+        return sql, (kind, since, kind, since, since)
+
+    def check_rollup(self, since):
+        """
+        Check that the rollup gives the same per-item aggregates as statistic
+        """
+        aggregate = """select data,agg_median(time),agg_median(viscosity),sum(count),sum(mistakes)
+            from (%s) group by data order by data"""
+        for kind in range(3):
+            source, args = self.statistic_source(kind, since)
+            full = "select data,time,viscosity,count,mistakes from statistic where type = ? and w >= ?"
+            if self.fetchall(aggregate % source, args) != self.fetchall(aggregate % full, (kind, since)):
+                return False
+        return True
+
     def get_source(self, source, lesson=None):
         srcids = self.fetchall('select rowid from source where name = ? limit 1', (source, ))
         if srcids:
@@ -179,13 +722,150 @@ create view text_source as
         self.execute('insert into source (name,discount) values (?,?)', (source, lesson))
         return self.get_source(source)
 
+class DatabaseThread(threading.Thread):
+    """
+    Runs jobs off the main loop, in the order they were submitted, on a connection
+    of its own to the database that was current when each job was submitted. Jobs
+    are functions taking that connection; once a batch of jobs has run each job's
+    callback is called from the main loop with what the job returned and None, or
+    None and the exception if the job failed.
+    """
+    readonly = False
+    timeout = 5
+
+    def __init__(self):
+        super(DatabaseThread, self).__init__(daemon=True)
+        self.jobs = queue.Queue()
+        self.db = None
+        self.dbfile = None
+
+    def submit(self, job, callback=None, *args):
+        """
+        Queue job, with args for run_job
+        """
+        if not self.is_alive():
+            self.start()
+        self.jobs.put((DB_FILE, job, callback, args))
+
+    def flush(self):
+        """
+        Wait until everything submitted so far has run
+        """
+        if self.is_alive():
+            self.jobs.join()
+
+    def connect(self, dbfile):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+        self.db = connect(dbfile, self.readonly, self.timeout)
+        self.dbfile = dbfile
+
+    def run(self):
+        while True:
+            batch = [self.jobs.get()]
+            while not self.jobs.empty():
+                batch.append(self.jobs.get())
+
+            done = []
+            for dbfile, job, callback, args in batch:
+                if dbfile != self.dbfile:
+                    self.connect(dbfile)
+                done.append((callback, *self.run_job(job, *args)))
+            self.db.commit()
+
+            for callback, result, error in done:
+                if callback is not None:
+                    GLib.idle_add(callback, result, error)
+            for _ in batch:
+                self.jobs.task_done()
+
+    def run_job(self, job):
+        """
+        Returns what the job returned and None, or None and the exception
+        """
+        try:
+            return job(self.db), None
+        except Exception as err:
+            traceback.print_exc()
+            return None, err
+
+class DatabaseWriter(DatabaseThread):
+    """
+    Runs database writes, committing each batch before the callbacks are called.
+    Jobs submitted with transaction=False run after what came before them is
+    committed, outside any transaction (e.g. for VACUUM).
+    """
+    timeout = 60
+    busy_retries = 5
+
+    def submit(self, job, callback=None, transaction=True):
+        super(DatabaseWriter, self).submit(job, callback, transaction)
+
+    def run_job(self, job, transaction):
+        """
+        Run a job, trying again while another connection keeps the database locked
+        """
+        for attempt in range(self.busy_retries + 1):
+            if transaction:
+                self.db.execute("savepoint job")
+            else:
+                self.db.commit()
+            try:
+                result = job(self.db)
+            except Exception as err:
+                if self.db.in_transaction and transaction:
+                    self.db.execute("rollback to job")
+                    self.db.execute("release job")
+                elif self.db.in_transaction:
+                    self.db.rollback()
+                busy = isinstance(err, sqlite3.OperationalError) and "locked" in str(err)
+                if not busy or attempt == self.busy_retries:
+                    traceback.print_exc()
+                    return None, err
+                print("database is locked, trying again")
+                time.sleep(attempt + 1)
+                continue
+            if transaction:
+                self.db.execute("release job")
+            return result, None
+
+class DatabaseReader(DatabaseThread):
+    """
+    Runs queries on a read-only connection, which sees what was committed when
+    each job starts
+    """
+    readonly = True
+
+def connect(dbfile, readonly=False, timeout=5):
+    """
+    Open dbfile in WAL mode, so readers and the writer don't block each other, with
+    the tuned PRAGMAS. Connections that may write set up the schema; read-only ones
+    are for queries from background threads.
+    """
+    if readonly:
+        db = sqlite3.connect(f"file:{urllib.parse.quote(dbfile)}?mode=ro", timeout, 0,
+                             "DEFERRED", False, AmphDatabase, STATEMENT_CACHE, uri=True)
+    else:
+        db = sqlite3.connect(dbfile, timeout, 0, "DEFERRED", False, AmphDatabase, STATEMENT_CACHE)
+        db.execute("pragma journal_mode = wal")
+    db.executescript(PRAGMAS)
+    if not readonly:
+        db.setup()
+    return db
+
 # GLOBAL
-DB = sqlite3.connect(database_path(), 5, 0, "DEFERRED", False, AmphDatabase)
+DB_FILE = database_path()
+DB = connect(DB_FILE)
+WRITER = DatabaseWriter()
+READER = DatabaseReader()
 
 def switchdb(newfile):
-    global DB
+    global DB, DB_FILE
     DB.commit()
     try:
-        DB = sqlite3.connect(newfile, 5, 0, "DEFERRED", False, AmphDatabase)
+        old, DB = DB, connect(newfile)
+        DB_FILE = newfile
+        old.close()
     except Exception as e:
         GtkUtil.show_dialog("Database Error", "Failed to switch to the new database:\n" + str(e))
@@ -4,10 +4,10 @@ import time
 
 import gi
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk
+from gi.repository import Gtk, GLib
 
 from Config import Settings, SettingsEdit
-from Data import DB
+from Data import DB, WRITER, READER
 import GtkUtil
 
 class DatabaseWidget(GtkUtil.AmphBoxLayout):
@@ -16,9 +16,14 @@ class DatabaseWidget(GtkUtil.AmphBoxLayout):
 
         self.stats = GtkUtil.new_label("Press Update to fetch database statistics")
         self.progressbar = Gtk.ProgressBar()
+        self.go_button = GtkUtil.new_button("Go!", self.cleanup)
+        self.removed = 0
+        self.errors = [] # of the cleanup in progress
 
         self.append_layout([
-            [GtkUtil.new_button("Update", self.update)],
+            [GtkUtil.new_button("Update", self.update),
+             GtkUtil.new_button("Table sizes", self.show_sizes),
+             GtkUtil.new_button("Query profile", self.show_profile)],
             0,
             self.stats,
             0,
@@ -31,64 +36,88 @@ class DatabaseWidget(GtkUtil.AmphBoxLayout):
             [SettingsEdit("group_month"), "days into months"],
             [SettingsEdit("group_week"), "days into weeks"],
             [SettingsEdit("group_day"), "days into days"],
-            [GtkUtil.new_button("Go!", self.cleanup)],
+            [self.go_button],
             None,
             self.progressbar
             ])
 
     def update(self):
-        texts = DB.fetchone("select count(*) from text", (0,))[0]
-        self.progressbar.set_fraction(1/4)
-        results = DB.fetchone("select count(*) from result", (0,))[0]
-        self.progressbar.set_fraction(2/4)
-        keys, trigrams, words = DB.fetchall(
-            "select count(*),sum(count) from statistic group by type order by type")
-        self.progressbar.set_fraction(3/4)
-        first = DB.fetchone("select w from result order by w asc limit 1", (time.time(), ))[0]
-        self.progressbar.set_fraction(4/4)
-
-        total = keys[0] + trigrams[0] + words[0]
-        history = (time.time() - first) / 86400
-
-        self.stats.set_text(f"""
-Texts: {texts}
-Results: {results}
-Analysis data: {total} ({keys[0]} keys, {trigrams[0]} trigrams, {words[0]} words)
-{keys[1]} characters and {words[1]} words typed in total.
+        counters = DB.counters()
+        first = DB.fetchone("select min(w) from result", (None, ))[0]
+        history = (time.time() - (first or time.time())) / 86400
+        keys, trigrams, words = (counters[f"statistic_{kind}"] for kind in range(3))
+
+        text = f"""
+Texts: {counters["texts"]}
+Results: {counters["results"]}
+Analysis data: {keys + trigrams + words} ({keys} keys, {trigrams} trigrams, {words} words)
+{counters["typed_0"]} characters and {counters["typed_2"]} words typed in total.
 First result was {round(history, 2)} days ago.
-""")
 
-        self.progressbar.set_fraction(0)
+Database size: {DB.size() / 1e6:.1f} MB
+"""
+        self.stats.set_text(text)
+
+    def show_sizes(self):
+        """
+        Measure each table and index in the background, as that reads the whole
+        database
+        """
+        DB.commit()
+        self.stats.set_text("Measuring tables...")
+        READER.submit(lambda db: db.table_sizes(), self.sizes_measured)
+
+    def sizes_measured(self, sizes, error):
+        if error is not None:
+            self.stats.set_text(f"Measuring tables failed: {error}")
+        elif sizes is None:
+            self.stats.set_text("This version of SQLite can't measure tables (no dbstat).")
+        else:
+            self.stats.set_text("".join(f"{name}: {size / 1e6:.1f} MB\n" for name, size in sizes))
+
+    def show_profile(self):
+        if not Settings.get("profile_queries"):
+            self.stats.set_text("Enable query profiling in the preferences first.")
+            return
+        self.stats.set_text(DB.profile_report(explain=True) or "No queries recorded yet.")
 
     def cleanup(self):
+        """
+        Compact old statistics into month/week/day rows and reclaim the space, in the
+        background
+        """
         s_in_day = 24*60*60
         now = time.time()
-        pending = []
-
-        for idx, grp, lim in [
-                (1, 30, Settings.get("group_month")),
-                (2, 7, Settings.get("group_week")),
-                (3, 1, Settings.get("group_day")),
-            ]:
-
-            minimum = now - s_in_day * lim
-            binsize = s_in_day * grp
-
-            pending.extend(DB.fetchall(f"""
-                select avg(w), data, type, agg_mean(time, count), sum(count), sum(mistakes),
-                    agg_median(viscosity)
-                from statistic where w <= {minimum}
-                group by data, type, cast(w/{binsize} as int)"""))
-            self.progressbar.set_fraction(idx/5)
-
-        DB.executemany("""insert into statistic (w, data, type, time, count, mistakes, viscosity)
-            values (?,?,?,?,?,?,?)""", pending)
-        self.progressbar.set_fraction(4/5)
-        # FIXME vacuum not supported
-        # DB.execute("vacuum")
-        self.progressbar.set_fraction(5/5)
+        tiers = [
+            (now - s_in_day * Settings.get("group_month"), s_in_day * 30),
+            (now - s_in_day * Settings.get("group_week"), s_in_day * 7),
+            (now - s_in_day * Settings.get("group_day"), s_in_day),
+            ]
+
         DB.commit()
+        size = DB.size()
+        progress = lambda fraction: GLib.idle_add(self.progressbar.set_fraction, 0.9 * fraction)
+        self.go_button.set_sensitive(False)
+        self.removed = 0
+        self.errors = []
+        WRITER.submit(lambda db: db.compact(tiers, progress), self.compacted)
+        WRITER.submit(lambda db: db.reclaim(), transaction=False,
+                      callback=lambda _, error: self.cleaned(size, error))
+
+    def compacted(self, removed, error):
+        if error is None:
+            self.removed = removed
+        else:
+            self.errors.append(f"Grouping old statistics failed: {error}")
+
+    def cleaned(self, size, error):
+        if error is not None:
+            self.errors.append(f"Reclaiming free space failed: {error}")
+        saved = size - DB.size()
+        self.stats.set_text("\n".join(self.errors + [
+            f"Removed {self.removed} rows of old statistics, saving {saved / 1e6:.1f} MB."]))
         self.progressbar.set_fraction(0)
+        self.go_button.set_sensitive(True)
 
 if __name__ == '__main__':
     GtkUtil.show_in_window(DatabaseWidget())
@@ -2,7 +2,7 @@
 
 import gi
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk
+from gi.repository import Gtk, GObject
 
 def new_button(label, callback):
     widget = Gtk.Button.new_with_label(label)
@@ -84,14 +84,25 @@ class AmphModel(Gtk.ListStore):
 
     def set_stats(self, data):
         self.clear()
+        self.append_stats(data)
+
+    def append_stats(self, data):
         for row in data:
             self.append(list(row))
 
 class AmphTreeView(Gtk.ScrolledWindow):
+    __gsignals__ = {
+        # scrolled to within a page of the last row, or the rows don't fill the view
+        "near-end": (GObject.SignalFlags.RUN_FIRST, None, ()),
+        }
+
     def __init__(self, model):
         Gtk.ScrolledWindow.__init__(self)
         self.treeview = Gtk.TreeView.new_with_model(model)
         self.add(self.treeview)
+        adjustment = self.get_vadjustment()
+        adjustment.connect("value-changed", self.scrolled)
+        adjustment.connect("changed", self.scrolled)
         renderer = Gtk.CellRendererText()
         for idx, col in enumerate(type(model).columns.items()):
             name = col[0]
@@ -110,6 +121,27 @@ class AmphTreeView(Gtk.ScrolledWindow):
             vcol.set_resizable(True)
             self.treeview.append_column(vcol)
 
+    def scrolled(self, adjustment):
+        if adjustment.get_value() + 2 * adjustment.get_page_size() >= adjustment.get_upper():
+            self.emit("near-end")
+
+class LazyPage(Gtk.Box):
+    """
+    Notebook page whose content is only built by factory when it is first shown
+    """
+    def __init__(self, factory):
+        Gtk.Box.__init__(self)
+        self.factory = factory
+        self.widget = None
+        self.connect("map", lambda _: self.build())
+
+    def build(self):
+        if self.widget is None:
+            self.widget = self.factory()
+            self.pack_start(self.widget, True, True, 0)
+            self.widget.show_all()
+        return self.widget
+
 def show_dialog(primary, secondary):
     dialog = Gtk.MessageDialog(text=primary, secondary_text=secondary, buttons=Gtk.ButtonsType.OK)
     dialog.run()
@@ -157,9 +157,7 @@ class LessonGenerator(GtkUtil.AmphBoxLayout):
             ]
 
         GtkUtil.AmphBoxLayout.__init__(self, layout)
-        Settings.connect("change_gen_take", lambda: self.generate_preview())
-        Settings.connect("change_gen_copies", lambda: self.generate_preview())
-        Settings.connect("change_gen_mix", lambda: self.generate_preview())
+        Settings.on_any_change(["gen_take", "gen_copies", "gen_mix"], self.generate_preview)
         self.strings.connect("updated", lambda _: self.generate_preview())
 
     def want_review(self, words):
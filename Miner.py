@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+"""
+Splitting text files into lessons. This only needs the standard library, so the
+worker processes of Text.mine_files can import it without loading the rest of
+Amphetype.
+"""
+
+import re
+import os
+import time
+import codecs
+import hashlib
+
+abbreviations = {
+        '1', '10', '11', '12', '2', '3', '4', '5', '6', '7', '8', '9',
+        'Ala', 'Alta', 'Ariz', 'Ark', 'Cal', 'Calif', 'Col', 'Colo', 'Conn',
+        'Dak', 'Del', 'Fed', 'Fla', 'Ga', 'Ia', 'Id', 'Ida', 'Ill', 'Ind',
+        'Is', 'Kan', 'Kans', 'Ken', 'Ky', 'La', 'Man', 'Mass', 'Md', 'Me',
+        'Mex', 'Mich', 'Minn', 'Miss', 'Mo', 'Mont', 'Neb', 'Nebr', 'Nev',
+        'Ok', 'Okla', 'Ont', 'Ore', 'Pa', 'Penn', 'Penna', 'Que', 'Sask',
+        'Tenn', 'Tex', 'USAFA', 'Ut', 'Va', 'Vt', 'Wash', 'Wis', 'Wisc', 'Wy',
+        'Wyo', 'Yuk', 'adm', 'al', 'apr', 'arc', 'assn', 'atty', 'attys',
+        'aug', 'ave', 'avg', 'bld', 'blvd', 'bros', 'capt', 'cl', 'cmdr', 'co',
+        'col', 'corp', 'cpl', 'cres', 'ct', 'dec', 'dept', 'det', 'dist', 'dr',
+        'eg', 'esp', 'etc', 'exp', 'expy', 'feb', 'ft', 'fwy', 'fy', 'gen',
+        'gov', 'hway', 'hwy', 'ie', 'inc', 'jan', 'jr', 'jul', 'jun', 'la',
+        'lt', 'ltd', 'm', 'maj', 'mar', 'may', 'mme', 'mr', 'mrs', 'ms', 'mt',
+        'no', 'nov', 'oct', 'pd', 'pde', 'pl', 'plz', 'prof', 'rd', 'rep',
+        'reps', 'rev', 'sen', 'sens', 'sep', 'sept', 'sgt', 'sr', 'st', 'supt',
+        'tce', 'univ', 'viz', 'vs'
+        }
+
+# A sentence ends with a run of [.?!], maybe a quote, and spaces before a word
+# that doesn't start in lower case. Runs ending in dots only count if the word
+# they end contains no other dots and isn't an abbreviation.
+ending_re = re.compile(r"""(?P<run>[.?!]+)['"]?(?= +(?:[^ a-z]|$))""")
+word_re = re.compile(r"\w+")
+
+class SentenceSplitter():
+    def __init__(self, text):
+        self.string = text
+
+    def __iter__(self):
+        string = self.string
+        start = 0
+        for mat in ending_re.finditer(string):
+            run = mat.group("run")
+            if run[-1] == ".":
+                dots = mat.start() + len(run.rstrip("."))
+                word = string.rfind(" ", 0, dots) + 1
+                if string.find(".", word, dots) >= 0:
+                    continue
+                pre = word_re.search(string, word, dots)
+                if pre is None or pre[0] in abbreviations or pre[0].lower() in abbreviations:
+                    continue
+            end = mat.end()
+            sentence = string[start:end].strip()
+            start = end
+            if sentence:
+                yield sentence
+        sentence = string[start:].strip()
+        if sentence:
+            yield sentence
+
+class LessonMiner():
+    """
+    Splits a file into lessons of at least min_chars characters, calling progress
+    with the percentage of the file read so far
+    """
+    def __init__(self, fname, min_chars, progress=lambda percent: None):
+        self.fname = fname
+        self.min_chars = min_chars
+        self.progress = progress
+
+    def __iter__(self):
+        """
+        Read the file incrementally, yielding lessons as soon as they are complete
+        """
+        size = max(os.path.getsize(self.fname), 1)
+        percent = 0
+        backlog = []
+        backlen = 0
+        with codecs.open(self.fname, "r", "utf_8_sig") as file:
+            for par in self.get_paras(file):
+                if backlog:
+                    backlog.append(None)
+
+                for sentence in par:
+                    backlog.append(sentence)
+                    backlen += len(sentence)
+                    if backlen >= self.min_chars:
+                        yield self.format(backlog)
+                        backlog = []
+                        backlen = 0
+
+                done = 100 * file.stream.tell() // size
+                if done != percent:
+                    percent = done
+                    self.progress(percent)
+        if backlen:
+            yield self.format(backlog)
+
+    def format(self, fragments):
+        ret = []
+        part = []
+        for item in fragments:
+            if item is not None:
+                part.append(item)
+            else:
+                ret.append(' '.join(part))
+                part = []
+
+        if part:
+            ret.append(' '.join(part))
+        return '\n'.join(ret)
+
+    def get_paras(self, file):
+        partial = []
+        for line in file:
+            line = line.strip()
+            if line:
+                partial.append(line)
+            elif partial:
+                yield SentenceSplitter(" ".join(partial))
+                partial = []
+        if partial:
+            yield SentenceSplitter(" ".join(partial))
+
+def text_hash(text):
+    hasher = hashlib.sha1()
+    hasher.update(text.encode("utf-8"))
+    return hasher.hexdigest()
+
+def mine_file(fname, min_chars):
+    """
+    Split a file into lessons, returning (fname, [(hash, lesson)], seconds, bytes)
+    """
+    start = time.perf_counter()
+    lessons = [(text_hash(lesson), lesson) for lesson in LessonMiner(fname, min_chars)]
+    return fname, lessons, time.perf_counter() - start, os.path.getsize(fname)
@@ -1,21 +1,54 @@
 #!/usr/bin/env python3
 
 import time
+import bisect
+from array import array
 
 import gi
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk, GObject
+from gi.repository import Gtk, GObject, GLib
 
 import GtkUtil
-from Data import DB
+from Data import DB, READER
 from Config import Settings, SettingsEdit, SettingsCombo, SettingsCheckBox
 import Plotters
 
 def dampen(seq, window=10):
+    """
+    Moving average, one value for each run of window values
+    """
+    if len(seq) < window:
+        return
     total = sum(seq[:window])
+    yield total/window
     for i in range(window, len(seq)):
-        yield total/window
         total += seq[i] - seq[i-window]
+        yield total/window
+
+def dampen_exponential(seq, window=10):
+    """
+    Exponential moving average, weighted to follow about as closely as a moving
+    average of window values, one value for each value
+    """
+    alpha = 2.0 / (window + 1)
+    avg = seq[0] if seq else 0.0
+    for val in seq:
+        avg += alpha * (val - avg)
+        yield avg
+
+def dampen_median(seq, window=10):
+    """
+    Moving median, one value for each run of window values
+    """
+    if len(seq) < window:
+        return
+    ordered = sorted(seq[:window])
+    middle = (window - 1) // 2
+    yield (ordered[middle] + ordered[window // 2]) / 2.0
+    for i in range(window, len(seq)):
+        del ordered[bisect.bisect_left(ordered, seq[i-window])]
+        bisect.insort(ordered, seq[i])
+        yield (ordered[middle] + ordered[window // 2]) / 2.0
 
 def format_when(when):
     delta = time.time() - when
@@ -37,6 +70,38 @@ def format_when(when):
     delta /= 52.0
     return f"{delta:.1f}y"
 
+def history_sql(where, groupby, **args):
+    """
+    Query and arguments for a page of the results matching the conditions in where
+    (with their parameters in args), newest first and grouped as by the perf_group_by
+    setting. The page starts below time :start and has :limit rows; the last column
+    is the oldest result of each row, where the next page starts.
+    """
+    where = " and ".join(where + ["r.w < :start"])
+    rows = f"""select r.* from result as r left join source as s on (r.source = s.rowid)
+        where {where}"""
+    if not groupby: # no grouping
+        return f"""select r.text_id,r.w,s.name,r.wpm,100.0*r.accuracy,r.viscosity,r.w
+            from result as r left join source as s on (r.source = s.rowid)
+            where {where}
+            order by r.w desc limit :limit""", args
+
+    if groupby == 1: # by def_group_by, counting back from the newest result
+        args["size"] = max(Settings.get("def_group_by"), 1)
+        rows = f"""select *,(row_number() over (order by w desc) - 1) / :size as grp
+            from ({rows} order by r.w desc limit :limit * :size)"""
+    elif groupby == 2: # by sitting, a new one starting after a break
+        args["mis"] = Settings.get("minutes_in_sitting") * 60.0
+        rows = f"""select *,sum(gap is null or gap >= :mis) over (order by w) as grp
+            from (select *,w - lag(w) over (order by w) as gap from ({rows}))"""
+    else: # by day
+        rows = f"""select *,cast((w+4*3600)/86400 as int) as grp from ({rows})"""
+    return f"""select agg_first(text_id),avg(w) as w,count(*) || ' result(s)',
+            agg_median(wpm),100.0*agg_median(accuracy),agg_median(viscosity),min(w)
+        from ({rows})
+        group by grp
+        order by w desc limit :limit""", args
+
 class ResultModel(GtkUtil.AmphModel):
     columns = {
         "ID": {
@@ -61,6 +126,7 @@ class PerformanceHistory(GtkUtil.AmphBoxLayout):
         "go-to-text": (GObject.SignalFlags.RUN_FIRST, None, ()),
         "set-text": (GObject.SignalFlags.RUN_FIRST, None, (str, int, str)),
         }
+    page_size = 200
 
     def __init__(self):
         GtkUtil.AmphBoxLayout.__init__(self)
@@ -70,6 +136,12 @@ class PerformanceHistory(GtkUtil.AmphBoxLayout):
 
         self.editflag = False
         self.model = ResultModel()
+        self.page_sql = None
+        self.page_args = {}
+        self.page_start = None
+        self.loaded = 0
+        self.graph = None
+        self.graph_generation = 0 # of the latest load_graph
 
         self.cb_source = Gtk.ComboBoxText()
         self.refresh_sources()
@@ -78,12 +150,14 @@ class PerformanceHistory(GtkUtil.AmphBoxLayout):
 
         tree = GtkUtil.AmphTreeView(self.model)
         tree.treeview.connect("row-activated", self.double_clicked)
-        Settings.on_any_change(["graph_what", "show_xaxis", "chrono_x", "dampen_graph"],
+        tree.connect("near-end", lambda _: self.load_page())
+        Settings.on_any_change(["graph_what", "show_xaxis", "chrono_x", "dampen_graph",
+                                "dampen_average", "dampen_method"],
                                self.update_graph)
         Settings.on_any_change(["perf_items", "perf_group_by", "lesson_stats"], self.update_data)
 
         self.append_layout([
-            ["Show", SettingsEdit("perf_items"), "items from", self.cb_source,
+            ["Show", SettingsEdit("perf_items"), "items (0 for all) from", self.cb_source,
              "and group by", SettingsCombo("perf_group_by", [
                  "<no grouping>", "%d sessions" % Settings.get("def_group_by"), "sitting", "day"]),
              None, GtkUtil.new_button("Update", self.update_data)],
@@ -95,25 +169,57 @@ class PerformanceHistory(GtkUtil.AmphBoxLayout):
             (self.plot, ),
             ])
 
-        self.update_data()
+        # let the tab appear before the history is fetched
+        GLib.idle_add(self.update_data)
 
     def update_graph(self):
-        what = Settings.get("graph_what")
-        y_coords = [row[what] for row in iter(self.model)]
+        if not self.graph:
+            return
+        y_coords = self.graph[Settings.get("graph_what")]
 
         if Settings.get("chrono_x"):
-            x_coords = [row[0] for row in iter(self.model)]
+            x_coords = self.graph[1]
         else:
-            x_coords = list(range(len(y_coords)-1, 0-1, -1))
+            x_coords = array("d", range(len(y_coords)))
 
         if Settings.get("dampen_graph"):
-            window = Settings.get("dampen_average")
-            y_coords = list(dampen(y_coords, window))
-            x_coords = list(dampen(x_coords, window))
+            window = max(Settings.get("dampen_average"), 1)
+            method = Settings.get("dampen_method")
+            if method == "e":
+                y_coords = list(dampen_exponential(y_coords, window))
+            else:
+                y_coords = list((dampen_median if method == "m" else dampen)(y_coords, window))
+                # each value stands for the middle of its window
+                x_coords = list(dampen(x_coords, window))
 
-        plot = Plotters.Plot(x_coords, y_coords)
+        plot = Plotters.Plot(x_coords, y_coords, Settings.get("show_xaxis"))
         self.plot.set_data(plot)
 
+    def load_graph(self):
+        """
+        Fetch the plotted columns of all perf_items rows, oldest first, on the reader
+        thread, so that long histories don't hold up the main loop
+        """
+        items = Settings.get("perf_items")
+        sql = f"select * from ({self.page_sql}) order by 2"
+        args = dict(self.page_args, start=float("inf"), limit=items if items > 0 else -1)
+        self.graph_generation += 1
+        generation = self.graph_generation
+
+        def fetch(db):
+            columns = {1: array("d"), 3: array("d"), 4: array("d"), 5: array("d")}
+            for row in db.execute(sql, args):
+                for idx, column in columns.items():
+                    column.append(row[idx])
+            return columns
+
+        def fetched(columns, error):
+            if error is None and generation == self.graph_generation:
+                self.graph = columns
+                self.update_graph()
+
+        READER.submit(fetch, fetched)
+
     def refresh_sources(self):
         self.editflag = True
         self.cb_source.remove_all()
@@ -129,7 +235,7 @@ class PerformanceHistory(GtkUtil.AmphBoxLayout):
         if self.editflag:
             return
         where = []
-        where_query = ""
+        args = {}
         selected = self.cb_source.get_active_id()
         if selected == "last text":
             where.append("r.text_id = (select text_id from result order by w desc limit 1)")
@@ -138,42 +244,31 @@ class PerformanceHistory(GtkUtil.AmphBoxLayout):
         elif selected == "all lessons":
             where.append("s.discount is not null")
         elif selected and selected.isdigit():
-            rowid = int(selected)
-            where.append(f"r.source = {rowid}")
-
-        if where:
-            where_query = "where " + " and ".join(where)
-
-        sql_template = """select agg_first(text_id),avg(r.w) as w,count(r.rowid)
-                || ' result(s)',agg_median(r.wpm),
-                100.0*agg_median(r.accuracy),agg_median(r.viscosity)
-            from result as r left join source as s on (r.source = s.rowid)
-            %s %s
-            order by w desc limit %d"""
+            where.append("r.source = :source")
+            args["source"] = int(selected)
 
         groupby = Settings.get("perf_group_by")
-        group = ""
         print(groupby)
-        if groupby == 1: # by def_group_by
-            DB.reset_counter()
-            group = "group by cast(counter()/%d as int)" % max(Settings.get("def_group_by"), 1)
-        elif groupby == 2: # by sitting
-            mis = Settings.get("minutes_in_sitting") * 60.0
-            DB.reset_time_group()
-            group = "group by time_group(%f, r.w)" % mis
-        elif groupby == 3: # by day
-            group = "group by cast((r.w+4*3600)/86400 as int)"
-        elif not groupby: # no grouping
-            sql_template = """select text_id,w,s.name,wpm,100.0*accuracy,viscosity
-                from result as r left join source as s on (r.source = s.rowid)
-                %s %s
-                order by w desc limit %d"""
+        self.page_sql, self.page_args = history_sql(where, groupby, **args)
+        self.page_start = float("inf")
+        self.loaded = 0
+        self.model.clear()
+        self.load_page()
+        self.load_graph()
 
+    def load_page(self):
+        """
+        Append the next page of results to the model, up to perf_items (0 for no limit)
+        """
         items = Settings.get("perf_items")
+        limit = self.page_size if items <= 0 else min(self.page_size, items - self.loaded)
+        if self.page_start is None or limit <= 0:
+            return
 
-        sql = sql_template % (where_query, group, items)
-        self.model.set_stats([list(r) for r in DB.fetchall(sql)])
-        self.update_graph()
+        rows = DB.fetchall(self.page_sql, dict(self.page_args, start=self.page_start, limit=limit))
+        self.page_start = rows[-1][-1] if len(rows) == limit else None
+        self.loaded += len(rows)
+        self.model.append_stats(row[:-1] for row in rows)
 
     def double_clicked(self, treeview, where, _column):
         row = Gtk.TreeModelRow(treeview.get_model(), where)
@@ -1,21 +1,158 @@
 #!/usr/bin/env python3
 
+import math
+
 import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk
-
-# TODO implement plotting
+import cairo
 
 class Plot():
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-        pass
+    """
+    A series of points, kept sorted by x
+    """
+    def __init__(self, x, y, xaxis=False):
+        points = sorted(zip(x, y))
+        self.x = [p[0] for p in points]
+        self.y = [p[1] for p in points]
+        # include y = 0 in the range and draw the x-axis there
+        self.xaxis = xaxis
+        self.columns = (None, None)
+
+    def __len__(self):
+        return len(self.x)
+
+    def y_range(self):
+        low, high = min(self.y), max(self.y)
+        if self.xaxis:
+            low, high = min(low, 0.0), max(high, 0.0)
+        if low == high:
+            low, high = low - 1.0, high + 1.0
+        return low, high
+
+    def decimate(self, width):
+        """
+        Reduce the series to the first, lowest, highest and last point of each of
+        width pixel columns, which draws the same line as the full series
+        """
+        if self.columns[0] == width:
+            return self.columns[1]
+        x_low, x_high = self.x[0], self.x[-1]
+        scale = (width - 1) / (x_high - x_low) if x_high > x_low else 0.0
+
+        # [x in pixels, first, lowest, highest, last] per column
+        columns = []
+        column = None
+        for x, y in zip(self.x, self.y):
+            pixel = int((x - x_low) * scale)
+            if column is None or column[0] != pixel:
+                column = [pixel, y, y, y, y]
+                columns.append(column)
+            else:
+                if y < column[2]:
+                    column[2] = y
+                elif y > column[3]:
+                    column[3] = y
+                column[4] = y
+        self.columns = (width, columns)
+        return columns
+
+class Plotter(Gtk.DrawingArea):
+    """
+    Line graph of a Plot, rendered once per data or size change into a cached surface
+    """
+    margin = (8, 8, 20, 56) # top, right, bottom, left
+    ticks = 5
 
-class Plotter(Gtk.Label):
     def __init__(self):
-        Gtk.Label.__init__(self, label="not yet implemented")
+        Gtk.DrawingArea.__init__(self)
+        self.set_size_request(-1, 200)
         self.data = None
+        self.surface = None
+        self.connect("draw", self.draw)
 
     def set_data(self, data):
         self.data = data
+        self.invalidate()
+
+    def invalidate(self):
+        self.surface = None
+        self.queue_draw()
+
+    def draw(self, _widget, ctx):
+        width, height = self.get_allocated_width(), self.get_allocated_height()
+        if self.surface is None or (self.surface.get_width(), self.surface.get_height()) \
+           != (width, height):
+            self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+            self.render(cairo.Context(self.surface), width, height)
+        ctx.set_source_surface(self.surface, 0, 0)
+        ctx.paint()
+        return False
+
+    def render(self, ctx, width, height):
+        color = self.get_style_context().get_color(self.get_state_flags())
+        ctx.set_source_rgba(color.red, color.green, color.blue, color.alpha)
+        ctx.set_line_width(1.0)
+
+        if self.data is None or len(self.data) < 2:
+            self.label(ctx, "no data", width / 2, height / 2, 0.5)
+            return
+
+        top, right, bottom, left = self.margin
+        plot_w, plot_h = width - left - right, height - top - bottom
+        if plot_w < 2 or plot_h < 2:
+            return
+
+        y_low, y_high = self.data.y_range()
+        y_scale = plot_h / (y_high - y_low)
+        to_y = lambda y: top + plot_h - (y - y_low) * y_scale
+
+        # y ticks and labels
+        ctx.save()
+        ctx.set_source_rgba(color.red, color.green, color.blue, 0.25 * color.alpha)
+        for i in range(self.ticks + 1):
+            py = math.floor(top + plot_h * i / self.ticks) + 0.5
+            ctx.move_to(left, py)
+            ctx.line_to(left + plot_w, py)
+        ctx.stroke()
+        ctx.restore()
+        for i in range(self.ticks + 1):
+            value = y_high - (y_high - y_low) * i / self.ticks
+            self.label(ctx, f"{value:.4g}", left - 4, top + plot_h * i / self.ticks, 1.0)
+
+        if self.data.xaxis:
+            py = math.floor(to_y(0.0)) + 0.5
+            ctx.move_to(left, py)
+            ctx.line_to(left + plot_w, py)
+            ctx.stroke()
+
+        # the series, at most four points per pixel column
+        ctx.rectangle(left, top, plot_w, plot_h)
+        ctx.clip()
+        ctx.set_line_join(cairo.LINE_JOIN_ROUND)
+        ctx.move_to(left, to_y(self.data.y[0]))
+        for pixel, first, low, high, last in self.data.decimate(plot_w):
+            px = left + pixel + 0.5
+            ctx.line_to(px, to_y(first))
+            if low != high:
+                ctx.line_to(px, to_y(low))
+                ctx.line_to(px, to_y(high))
+            ctx.line_to(px, to_y(last))
+        ctx.stroke()
+
+    @staticmethod
+    def label(ctx, text, x, y, align):
+        """
+        Draw text vertically centred at y, aligned at x by align (0 left, 1 right)
+        """
+        extents = ctx.text_extents(text)
+        ctx.move_to(x - align * extents.x_advance, y + extents.height / 2)
+        ctx.show_text(text)
+
+if __name__ == "__main__":
+    import random
+    import GtkUtil
+    plotter = Plotter()
+    values = [random.gauss(60, 10) for _ in range(200000)]
+    plotter.set_data(Plot(list(range(len(values))), values))
+    GtkUtil.show_in_window(plotter)
@@ -1,14 +1,16 @@
 #!/usr/bin/env python3
 
 import collections
-from time import time as timer
+import itertools
+from time import time as timer, perf_counter_ns
+from array import array
 import re
 
 import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, Gdk, GObject, Pango
 
-from Data import Statistic, DB
+from Data import DB, WRITER, median
 from Config import Settings
 import GtkUtil
 
@@ -19,6 +21,55 @@ def get_wait_text():
     return "Press ESCAPE to restart with a new text at any time"
 
 
+word_re = re.compile(r"(\w|'(?![A-Z]))+(-\w(\w|')*)*")
+
+def statistic_kind(key):
+    if len(key) == 1:
+        return 0
+    if len(key) == 3:
+        return 1
+    return 2
+
+def extract_statistics(text, times, mis, spc, now):
+    """
+    Per key, trigram and word statistics of a typed text, as
+    (time, viscosity, w, count, mistakes, type, data) rows for AmphDatabase.add_statistics
+    """
+    # Prefix sums of the times, their squares and the mistakes give the average time,
+    # viscosity and mistakes of any span in constant time
+    sums = list(itertools.accumulate(times, initial=0.0))
+    squares = list(itertools.accumulate((t*t for t in times), initial=0.0))
+    flaws = list(itertools.accumulate(mis, initial=0))
+
+    stats = collections.defaultdict(list)
+    viscs = collections.defaultdict(list)
+    flawed = collections.Counter()
+
+    for char, time, mistake in zip(text, times, mis):
+        stats[char].append(time)
+        viscs[char].append((time/spc - 1)**2)
+        flawed[char] += bool(mistake)
+
+    def add_span(start, end):
+        key = text[start:end]
+        span = end - start
+        total = sums[end] - sums[start]
+        stats[key].append(total / span)
+        # mean of (t/avg - 1)**2 over the span, expanded in terms of the sums
+        viscs[key].append(span * (squares[end] - squares[start]) / (total * total) - 1)
+        flawed[key] += flaws[end] > flaws[start]
+
+    for i in range(0, len(text) - 2):
+        add_span(i, i+3)
+
+    for mat in word_re.finditer(text):
+        if mat.end() - mat.start() > 3:
+            add_span(*mat.span())
+
+    return [(median(stat), median(viscs[key])*100.0, now, len(stat), flawed[key],
+             statistic_kind(key), key) for key, stat in stats.items()]
+
+
 class Typer(Gtk.TextView):
     __gsignals__ = {
         "done": (GObject.SignalFlags.RUN_FIRST, None, ()),
@@ -33,7 +84,10 @@ class Typer(Gtk.TextView):
         sync_font()
 
         self.connect("key-press-event", lambda _, key: self.key_press(key))
-        self.get_buffer().connect("end-user-action", lambda _: self.check_text())
+        buf = self.get_buffer()
+        buf.connect("insert-text", lambda _, where, *_2: self.mark_changed(where.get_offset()))
+        buf.connect("delete-range", lambda _, start, _2: self.mark_changed(start.get_offset()))
+        buf.connect("end-user-action", lambda _: self.check_text())
         Settings.on_any_change([
             "quiz_wrong_fg",
             "quiz_wrong_bg",
@@ -45,6 +99,11 @@ class Typer(Gtk.TextView):
         self.set_target("") # clear input
 
     def key_press(self, key):
+        # timestamp keys as they arrive, before the buffer and layout are updated
+        self.pressed = perf_counter_ns()
+        if Settings.get("log_keystrokes"):
+            self.key_times.append(self.pressed)
+            self.key_vals.append(key.keyval)
         if Gdk.keyval_name(key.keyval) == "Escape":
             self.emit("want-text")
             return True
@@ -53,32 +112,52 @@ class Typer(Gtk.TextView):
     def set_target(self, text):
         self.edit_flag = True
         self.target = text
-        self.when = [0] * (len(text) + 1)
-        self.times = [0] * len(text)
+        # perf_counter_ns() when each character was first correctly typed
+        self.when = array("q", [0]) * (len(text) + 1)
+        self.times = array("d", [0.0]) * len(text)
+        self.pressed = 0
+        self.key_times = array("q")
+        self.key_vals = array("I")
         self.mistake = [False] * len(text)
         self.mistakes = {}
         self.where = 0
+        self.changed = 0
 
         self.get_buffer().set_text(get_wait_text(), -1)
         self.get_buffer().select_range(*self.get_buffer().get_bounds())
         self.edit_flag = False
 
+    def keystroke_time(self):
+        """
+        Time of the key press behind the current change, or now if there was none
+        (e.g. text pasted with the mouse)
+        """
+        pressed, self.pressed = self.pressed, 0
+        return pressed or perf_counter_ns()
+
+    def mark_changed(self, offset):
+        """
+        Note that the buffer changed at offset, so input before it is unchanged
+        """
+        self.changed = min(self.changed, offset)
+
     def check_text(self):
         if not self.target or self.edit_flag:
             return
 
-        text = GtkUtil.textbuf_get_text(self.get_buffer())
+        buf = self.get_buffer()
+        length = buf.get_char_count()
         if self.when[0] == 0: # We're just starting
-            space = text and text[-1] == " "
+            space = length and buf.get_iter_at_offset(length - 1).get_char() == " "
 
             self.edit_flag = True
             if space:
-                self.when[0] = timer()
-                self.get_buffer().set_text("", -1)
+                self.when[0] = self.keystroke_time()
+                buf.set_text("", -1)
                 self.update_palette("right")
             elif Settings.get("req_space"): # reset
-                self.get_buffer().set_text(get_wait_text(), -1)
-                self.get_buffer().select_range(*self.get_buffer().get_bounds())
+                buf.set_text(get_wait_text(), -1)
+                buf.select_range(*buf.get_bounds())
 
             self.edit_flag = False
 
@@ -86,28 +165,30 @@ class Typer(Gtk.TextView):
                 return
             self.when[0] = -1
 
-        # find first difference
-        for upto in range(min(len(text), len(self.target))):
-            if text[upto] != self.target[upto]:
-                break
-        else:
-            upto = min(len(text), len(self.target))
+        # find first difference, only looking at what changed since the last check
+        start = min(self.where, self.changed)
+        self.changed = length
+        text = buf.get_text(buf.get_iter_at_offset(start), buf.get_end_iter(), True)
+        upto = start
+        end = min(length, len(self.target))
+        while upto < end and text[upto - start] == self.target[upto]:
+            upto += 1
         self.where = upto
 
-        if self.when[upto] == 0 and upto == len(text):
-            self.when[upto] = timer()
+        if self.when[upto] == 0 and upto == length:
+            self.when[upto] = self.keystroke_time()
             if upto:
-                self.times[upto-1] = self.when[upto] - self.when[upto-1]
+                self.times[upto-1] = (self.when[upto] - self.when[upto-1]) / 1e9
 
         if upto == len(self.target):
             self.emit("done")
             return
 
-        if upto < len(text) and upto < len(self.target):
+        if upto < length and upto < len(self.target):
             self.mistake[upto] = True
-            self.mistakes[upto] = self.target[upto] + text[upto]
+            self.mistakes[upto] = self.target[upto] + text[upto - start]
 
-        self.update_palette("right" if upto == len(text) else "wrong")
+        self.update_palette("right" if upto == length else "wrong")
 
     def get_mistakes(self):
         inv = collections.defaultdict(lambda: 0)
@@ -121,10 +202,18 @@ class Typer(Gtk.TextView):
             self.times[0] = DB.fetchone(
                 "select time from statistic where type=0 and data=? order by rowid desc limit 1",
                 (times[len(times)//5], ), (self.target[0], ))[0]
-            self.when[0] = self.when[1] - self.times[0]
-        return (self.when[self.where] - self.when[0], self.where, self.times,
+            self.when[0] = self.when[1] - int(self.times[0] * 1e9)
+        return ((self.when[self.where] - self.when[0]) / 1e9, self.where, self.times,
                 self.mistake, self.get_mistakes())
 
+    def get_keystrokes(self):
+        """
+        Logged key presses as blobs of nanoseconds since the start and of keyvals
+        """
+        start = self.when[0]
+        return (array("q", (t - start for t in self.key_times)).tobytes(),
+                self.key_vals.tobytes())
+
     def update_palette(self, which=None):
         # TODO use configured colors
         if which == "right":
@@ -173,10 +262,10 @@ class Quizzer(Gtk.Box):
 
     def done(self):
         print("DONE")
-        # TODO split into smaller bits
         now = timer()
         elapsed, chars, times, mis, mistakes = self.typer.get_stats()
         text = self.text[2]
+        keystrokes = self.typer.get_keystrokes() if Settings.get("log_keystrokes") else None
 
         assert chars == len(text)
 
@@ -184,72 +273,68 @@ class Quizzer(Gtk.Box):
         spc = elapsed / chars
         viscosity = sum((t / spc - 1) ** 2 for t in times) / chars
 
-        DB.execute("""insert into result (w, text_id, source, wpm, accuracy, viscosity)
-                   values (?,?,?,?,?,?)""",
-                   (now, self.text[0], self.text[1], 12.0/spc, accuracy, viscosity))
-
-        wpm_median, acc_median = DB.fetchone(f"""select agg_median(wpm),agg_median(acc) from
-            (select wpm,100.0*accuracy as acc from result order by w desc limit
-             {Settings.get("def_group_by")})""", (0.0, 100.0))
-
-        self.result.set_text(
-            "Last: {:.1f}wpm ({:.1f}%), last 10 average: {:.1f}wpm ({:.1f}%)".format(
-                12.0/spc, 100.0*accuracy, wpm_median, acc_median))
-
-        self.emit("stats-changed")
-
-        stats = collections.defaultdict(Statistic)
-        viscs = collections.defaultdict(Statistic)
-
-        for char, time, mistake in zip(text, times, mis):
-            stats[char].append(time, mistake)
-            viscs[char].append((time/spc - 1)**2)
-
-        def gen_tup(start, end):
-            span = end - start
-            char_avg = sum(times[start:end]) / span
-            visc = sum((t/char_avg - 1)**2 for t in times[start:end]) / span
-            return (text[start:end], char_avg, sum(1 for f in mis[start:end] if f), visc)
-
-        for trigraph, time, mist, visc in [gen_tup(i, i+3) for i in range(0, chars - 2)]:
-            stats[trigraph].append(time, mist > 0)
-            viscs[trigraph].append(visc)
-
-        regex = re.compile(r"(\w|'(?![A-Z]))+(-\w(\w|')*)*")
-        for word, time, mist, visc in [
-                gen_tup(*m.span()) for m in regex.finditer(text) if m.end() - m.start() > 3]:
-            stats[word].append(time, mist > 0)
-            viscs[word].append(visc)
-
-        def kind(key):
-            if len(key) == 1:
-                return 0
-            if len(key) == 3:
-                return 1
-            return 2
-
-        vals = []
-        for key, stat in stats.items():
-            visc = viscs[key].median()
-            vals.append((stat.median(), visc*100.0, now, len(stat), stat.flawed(), kind(key), key))
-
         is_lesson = DB.fetchone("select discount from source where rowid=?",
                                 (None,), (self.text[1], ))[0]
-
-        if Settings.get("use_lesson_stats") or not is_lesson:
-            DB.executemany("""insert into statistic (time,viscosity,w,count,mistakes,type,data)
-                    values (?,?,?,?,?,?,?)""", vals)
-            DB.executemany("insert into mistake (w,target,mistake,count) values (?,?,?,?)",
-                           [(now, k[0], k[1], v) for k, v in mistakes.items()])
+        save_stats = Settings.get("use_lesson_stats") or not is_lesson
 
         if is_lesson:
             mins = (Settings.get("min_lesson_wpm"), Settings.get("min_lesson_acc"))
         else:
             mins = (Settings.get("min_wpm"), Settings.get("min_acc"))
-
-        if 12.0/spc < mins[0] or accuracy < mins[1]/100.0:
+        repeat = 12.0/spc < mins[0] or accuracy < mins[1]/100.0
+        # texts that are repeated aren't reviewed
+        review = not repeat and not is_lesson and Settings.get('auto_review')
+        # in order selection continues from the last saved result, so wait for this one
+        in_order = not repeat and not review and Settings.get('select_method') == 1
+        result_row = (now, self.text[0], self.text[1], 12.0/spc, accuracy, viscosity)
+
+        def store(db):
+            result = db.execute("""insert into result (w, text_id, source, wpm, accuracy, viscosity)
+                       values (?,?,?,?,?,?)""", result_row).lastrowid
+            if keystrokes is not None:
+                db.execute("insert into keystroke (result, times, keys) values (?,?,?)",
+                           (result, *keystrokes))
+
+            vals = []
+            if save_stats or review:
+                vals = extract_statistics(text, times, mis, spc, now)
+            if save_stats:
+                db.add_statistics(vals)
+                db.executemany("insert into mistake (w,target,mistake,count) values (?,?,?,?)",
+                               [(now, k[0], k[1], v) for k, v in mistakes.items()])
+            return vals
+
+        medians = DB.add_recent_result(now, 12.0/spc, accuracy)
+        WRITER.submit(store, lambda vals, error:
+                      self.stored(12.0/spc, accuracy, review, in_order, medians, vals, error))
+
+        if repeat:
             self.set_target(self.text)
-        elif not is_lesson and Settings.get('auto_review'):
+        elif not review and not in_order:
+            self.emit("want-text")
+
+    def stored(self, wpm, accuracy, review, in_order, medians, vals, error):
+        """
+        Called once the writer has saved the result of done(), or failed to
+        """
+        if error is not None:
+            self.result.set_text(
+                "Last: {:.1f}wpm ({:.1f}%), could not be saved: {}".format(
+                    wpm, 100.0*accuracy, error))
+            if review or in_order:
+                self.emit("want-text")
+            return
+
+        wpm_median, acc_median = medians
+        self.result.set_text(
+            "Last: {:.1f}wpm ({:.1f}%), last 10 average: {:.1f}wpm ({:.1f}%)".format(
+                wpm, 100.0*accuracy, wpm_median, acc_median))
+
+        self.emit("stats-changed")
+
+        if in_order:
+            self.emit("want-text")
+        elif review:
             words = [x for x in vals if x[5] == 2]
             if not words:
                 self.emit("want-text")
@@ -262,8 +347,6 @@ class Quizzer(Gtk.Box):
 
             # TODO support want-review
             # self.emit("want-review", [x[6] for x in words[0:i]])
-        else:
-            self.emit("want-text")
 
 if __name__ == "__main__":
     quizzer = Quizzer()
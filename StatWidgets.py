@@ -5,7 +5,7 @@ import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk
 
-from Data import DB
+from Data import DB, READER
 import GtkUtil
 import Text
 from Config import Settings, SettingsCombo, SettingsEdit
@@ -21,34 +21,35 @@ class WordModel(GtkUtil.AmphModel):
         "Impact": float,
         }
 
+# orderings of the analysis list, which can't be passed as SQL parameters
+ORDERINGS = [
+    ('wpm asc', 'slowest'),
+    ('wpm desc', 'fastest'),
+    ('viscosity desc', 'least fluid'),
+    ('viscosity asc', 'most fluid'),
+    ('accuracy asc', 'least accurate'),
+    ('misses desc', 'most mistyped'),
+    ('total desc', 'most common'),
+    ('damage desc', 'most damaging'),
+    ]
+
 class StringStats(GtkUtil.AmphBoxLayout):
     def __init__(self):
         GtkUtil.AmphBoxLayout.__init__(self)
         self.model = WordModel()
+        self.generation = 0 # of the latest update
         treeview = GtkUtil.AmphTreeView(self.model)
 
         self.update()
 
-        which = SettingsCombo('ana_which', [
-            ('wpm asc', 'slowest'),
-            ('wpm desc', 'fastest'),
-            ('viscosity desc', 'least fluid'),
-            ('viscosity asc', 'most fluid'),
-            ('accuracy asc', 'least accurate'),
-            ('misses desc', 'most mistyped'),
-            ('total desc', 'most common'),
-            ('damage desc', 'most damaging'),
-            ])
+        which = SettingsCombo('ana_which', ORDERINGS)
 
         what = SettingsCombo('ana_what', ['keys', 'trigrams', 'words'])
         lim = SettingsEdit('ana_many')
         mincount = SettingsEdit('ana_count')
 
         # XXX why are sometimes no args provided, sometimes Config.Settings?
-        Settings.connect("change_ana_which", lambda *_: self.update())
-        Settings.connect("change_ana_what", lambda *_: self.update())
-        Settings.connect("change_ana_many", lambda *_: self.update())
-        Settings.connect("change_ana_count", lambda *_: self.update())
+        Settings.on_any_change(["ana_which", "ana_what", "ana_many", "ana_count"], self.update)
 
         # TODO send lessons to generator
         send_to_generator = lambda: None
@@ -63,11 +64,14 @@ class StringStats(GtkUtil.AmphBoxLayout):
 
     def update(self):
         which = Settings.get("ana_which")
+        if which not in dict(ORDERINGS):
+            which = ORDERINGS[0][0]
         what = Settings.get("ana_what")
         limit = Settings.get("ana_many")
         least = Settings.get("ana_count")
         hist = time.time() - Settings.get("history") * 86400.0
 
+        source, args = DB.statistic_source(what, hist)
         sql = f"""select data,12.0/time as wpm,
             100.0-100.0*misses/cast(total as real) as accuracy,
             viscosity,total,misses,
@@ -75,11 +79,19 @@ class StringStats(GtkUtil.AmphBoxLayout):
                 from
                     (select data,agg_median(time) as time,agg_median(viscosity) as viscosity,
                     sum(count) as total,sum(mistakes) as misses
-                    from statistic where w >= ? and type = ? group by data)
+                    from ({source}) group by data)
                 where total >= ?
-                order by {which} limit {limit}"""
+                order by {which} limit ?"""
+
+        # aggregate on the reader connection in the background, keeping only the latest
+        self.generation += 1
+        generation = self.generation
+
+        def done(rows, error):
+            if error is None and generation == self.generation:
+                self.model.set_stats(rows)
 
-        self.model.set_stats(DB.fetchall(sql, (hist, what, least)))
+        READER.submit(lambda db: db.fetchall(sql, (*args, least, limit)), done)
 
 if __name__ == '__main__':
     GtkUtil.show_in_window(StringStats())
@@ -2,17 +2,46 @@
 
 import os.path as path
 import time
-import hashlib
+import json
+import threading
 
 import gi
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk, GObject
+from gi.repository import Gtk, GObject, GLib
 
-from Text import LessonMiner
-from Data import DB
+from Miner import LessonMiner, text_hash
+from Text import expand_paths, mine_files
+from Data import DB, READER
 import GtkUtil
 from Config import Settings, SettingsEdit, SettingsCombo
 
+def store_mined(fname, mined, error):
+    """
+    Add a result of Text.mine_files to the database and commit it, returning a
+    summary line
+    """
+    if error is not None:
+        return f"{path.basename(fname)}: not imported, {error}"
+    _, lessons, seconds, size = mined
+    added = DB.add_texts(DB.get_source(fname), lessons)
+    DB.commit()
+    return (f"{path.basename(fname)}: {len(lessons)} lessons ({added} new),"
+            f" {size / max(seconds, 1e-9) / 1e6:.2f} MB/s")
+
+def import_files(paths):
+    """
+    Import files, directories and glob patterns in parallel, printing statistics
+    for each file. Files that can't be read are reported and skipped.
+    """
+    start = time.perf_counter()
+    files = expand_paths(paths)
+    failed = 0
+    for fname, mined, error in mine_files(files):
+        print(store_mined(fname, mined, error))
+        failed += error is not None
+    print(f"Imported {len(files) - failed} of {len(files)} files"
+          f" in {time.perf_counter() - start:.2f}s")
+
 class SourceModel(Gtk.TreeStore):
     columns = {
         "ID": int,
@@ -27,9 +56,13 @@ class SourceModel(Gtk.TreeStore):
         Gtk.TreeStore.__init__(self)
         self.set_column_types(list(SourceModel.columns.values()))
 
-        self.populate_data()
+    # stands in for the texts of a source until it is first expanded
+    placeholder = [-1, "...", 0, 0, 0.0, ""]
 
     def populate_data(self):
+        """
+        Load the sources, leaving their texts to load_texts
+        """
         self.clear()
         for source in DB.fetchall("""
             select s.rowid,s.name,t.count,r.count,r.wpm,ifelse(nullif(t.dis,t.count),'No','Yes')
@@ -41,13 +74,38 @@ class SourceModel(Gtk.TreeStore):
                 where s.disabled is null
                 order by s.name"""):
             s_iter = self.append(None, list(source))
-            for text in DB.fetchall("""
-                select t.rowid,substr(t.text,0,40)||"...",length(t.text),r.count,r.m,ifelse(t.disabled,'Yes','No')
-                from (select rowid,* from text where source = ?) as t
-                left join (select text_id,count(*) as count,agg_median(wpm) as m from result group by text_id) as r
-                    on (t.id = r.text_id)
-                order by t.rowid""", (source[0], )):
-                self.append(s_iter, list(text))
+            if source[2]:
+                self.append(s_iter, self.placeholder)
+
+    def load_texts(self, s_iter):
+        """
+        Replace the placeholder of the source at s_iter with its texts
+        """
+        child = self.iter_children(s_iter)
+        if child is None or self[child][0] != self.placeholder[0]:
+            return
+        for text in DB.fetchall("""
+            select t.rowid,substr(t.text,0,40)||'...',length(t.text),r.count,r.m,ifelse(t.disabled,'Yes','No')
+            from text as t
+            left join (select text_id,count(*) as count,agg_median(wpm) as m from result
+                       where text_id in (select id from text where source = ?1) group by text_id) as r
+                on (t.id = r.text_id)
+            where t.source = ?1
+            order by t.rowid""", (self[s_iter][0], )):
+            self.insert_before(s_iter, child, list(text))
+        self.remove(child)
+
+    def update_sources(self, s_iters):
+        """
+        Refresh the text count and disabled state of the sources at s_iters
+        """
+        rows = {self[s_iter][0]: s_iter for s_iter in s_iters}
+        for source, count, dis in DB.fetchall("""
+            select source,count(*),count(disabled) from text
+                where source in (select value from json_each(?))
+                group by source""", (json.dumps(list(rows)), )):
+            self[rows[source]][2] = count
+            self[rows[source]][5] = "Yes" if dis == count else "No"
 
 class TextManager(GtkUtil.AmphBoxLayout):
     __gsignals__ = {
@@ -56,6 +114,10 @@ class TextManager(GtkUtil.AmphBoxLayout):
         "set-text": (GObject.SignalFlags.RUN_FIRST, None, (str, int, str)),
         }
 
+    import_batch_size = 200
+    # texts sampled for difficult/easy selection while the library is being ranked
+    rank_sample = 50
+
     default_text = (
         "", 0,
         "Welcome to Amphetype!\n"
@@ -75,12 +137,15 @@ class TextManager(GtkUtil.AmphBoxLayout):
     def __init__(self):
         GtkUtil.AmphBoxLayout.__init__(self, orientation=Gtk.Orientation.HORIZONTAL)
 
-        self.diff_eval = lambda x: 1
+        self.scoring = False
+        self.ranking = None # text ids from fastest to slowest, see rank_texts
+        self.ranking_generation = 0
         self.model = SourceModel()
 
         treeview = GtkUtil.AmphTreeView(self.model)
         self.tree = treeview.treeview
         self.tree.connect("row-activated", self.double_clicked)
+        self.tree.connect("test-expand-row", lambda _, s_iter, _2: self.model.load_texts(s_iter))
         self.tree.get_selection().set_mode(Gtk.SelectionMode.MULTIPLE)
 
         self.progress = Gtk.ProgressBar()
@@ -93,6 +158,7 @@ class TextManager(GtkUtil.AmphBoxLayout):
                 (treeview, ),
                 self.progress,
                 [GtkUtil.new_button("Import Texts", self.add_files),
+                 GtkUtil.new_button("Import Directory", self.add_directory),
                  GtkUtil.new_button("Enable All", self.enable_all),
                  GtkUtil.new_button("Delete Disabled", self.delete_disabled),
                  GtkUtil.new_button("Update List", self.update)],
@@ -115,114 +181,207 @@ class TextManager(GtkUtil.AmphBoxLayout):
             ]])
 
         Settings.connect("change_select_method", lambda *_: self.set_select())
-        self.set_select()
+        Settings.connect("change_num_rand", lambda *_: self.rank_texts())
+        self.load_trigram_times()
+
+        # the tree is filled when the tab is first shown
+        self.tree_stale = True
+        self.connect("map", lambda _: self.tree_stale and self.refresh_tree())
 
     def set_select(self):
-        method = Settings.get("select_method")
-        if method in (0, 1):
-            self.diff_eval = lambda x: 1
-            self.next_text()
+        self.load_trigram_times()
+        self.next_text()
+
+    def load_trigram_times(self):
+        """
+        Estimate typing times of trigrams for difficult/easy selection
+        """
+        tri = {}
+        if Settings.get("select_method") in (2, 3):
+            hist = time.time() - 86400 * Settings.get("history")
+            source, args = DB.statistic_source(1, hist)
+            tri = dict(DB.fetchall(f"""
+                select data,agg_median(time) as wpm from ({source})
+                group by data""", args))
+        DB.set_trigram_times(tri)
+        self.scoring = bool(tri)
+        self.rank_texts()
+
+    def rank_texts(self):
+        """
+        Rank the whole library for difficult/easy selection in the background, if
+        it is set to consider all texts. The previous ranking is used until then.
+        """
+        self.ranking_generation += 1
+        if not self.scoring or Settings.get("num_rand") > 0:
+            self.ranking = None
             return
+        generation = self.ranking_generation
+        times = DB.trigram_times_
 
-        hist = time.time() - 86400 * Settings.get("history")
-        tri = dict(DB.execute("""
-            select data,agg_median(time) as wpm from statistic
-            where w >= ? and type = 1
-            group by data""", (hist, )).fetchall())
+        def ranked(ranking, error):
+            if error is None and generation == self.ranking_generation:
+                self.ranking = ranking
 
-        vals = list(tri.values())
-        if not vals:
-            self.diff_eval = lambda x: 1
-            self.next_text()
-            return
-        vals.sort(reverse=True)
-        expect = vals[len(vals) // 4]
-
-        def func(target):
-            text = target[2]
-            # FIXME what does v do here?
-            # v = 0
-            total = 0.0
-            for i in range(0, len(text)-2):
-                trigram = text[i:i+3]
-                if trigram in tri:
-                    total += tri[trigram]
-                else:
-                    total += expect
-                    # v += 1
-            avg = total / (len(text)-2)
-            return 12.0/avg
-        self.diff_eval = func
-        self.next_text()
+        READER.submit(lambda db: db.text_scores(times), ranked)
 
     def add_files(self):
-        filepicker = Gtk.FileChooserDialog()
+        filepicker = Gtk.FileChooserDialog(select_multiple=True)
         filepicker.add_button(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
         filepicker.add_button(Gtk.STOCK_OPEN, Gtk.ResponseType.ACCEPT)
         result = filepicker.run()
-        fname = filepicker.get_filename()
+        fnames = filepicker.get_filenames()
         filepicker.destroy()
-        if result == Gtk.ResponseType.CANCEL or fname is None:
+        if result == Gtk.ResponseType.CANCEL or not fnames:
             return
 
-        lminer = LessonMiner(fname)
-        lminer.connect("progress", lambda p: self.progress.set_fraction(p/100))
-        self.add_texts(fname, lminer, update=False)
-        self.progress.set_fraction(0)
+        if len(fnames) == 1:
+            self.import_file(fnames[0])
+        else:
+            self.import_paths(fnames)
 
-        self.update()
+    def add_directory(self):
+        filepicker = Gtk.FileChooserDialog(action=Gtk.FileChooserAction.SELECT_FOLDER)
+        filepicker.add_button(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+        filepicker.add_button(Gtk.STOCK_OPEN, Gtk.ResponseType.ACCEPT)
+        result = filepicker.run()
+        dirname = filepicker.get_filename()
+        filepicker.destroy()
+        if result == Gtk.ResponseType.CANCEL or dirname is None:
+            return
+
+        self.import_paths([dirname])
+
+    def import_paths(self, paths):
+        """
+        Mine several files in a process pool from a worker thread, storing each
+        file's lessons from the main loop as it is finished
+        """
+        files = expand_paths(paths)
+
+        def work():
+            errors = []
+            try:
+                for done, (fname, mined, error) in enumerate(mine_files(files), 1):
+                    if error is not None:
+                        errors.append(f"{path.basename(fname)}: {error}")
+                    GLib.idle_add(self.import_mined, fname, mined, error, done / len(files))
+            except Exception as err:
+                errors.append(str(err))
+            finally:
+                GLib.idle_add(self.import_done, errors)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def import_mined(self, fname, mined, error, fraction):
+        print(store_mined(fname, mined, error))
+        self.progress.set_fraction(fraction)
+        return False
+
+    def import_file(self, fname):
+        """
+        Split fname into lessons in a worker thread, adding them to the database in
+        batches from the main loop as they come in
+        """
+        idx = DB.get_source(fname)
+        lminer = LessonMiner(fname, Settings.get("min_chars"),
+                             lambda p: GLib.idle_add(self.progress.set_fraction, p/100))
+
+        def work():
+            errors = []
+            batch = []
+            try:
+                for lesson in lminer:
+                    batch.append((text_hash(lesson), lesson))
+                    if len(batch) >= self.import_batch_size:
+                        GLib.idle_add(self.import_batch, idx, batch)
+                        batch = []
+                GLib.idle_add(self.import_batch, idx, batch)
+            except Exception as err:
+                errors.append(f"{path.basename(fname)}: {err}")
+            finally:
+                GLib.idle_add(self.import_done, errors)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def import_batch(self, idx, batch):
+        """
+        Add and commit a batch of lessons, so the database isn't kept locked for the
+        whole import
+        """
+        DB.add_texts(idx, batch)
         DB.commit()
+        return False
+
+    def import_done(self, errors):
+        """
+        Called once an import has finished, with a line for each file that failed
+        """
+        DB.commit()
+        self.progress.set_fraction(0)
+        self.update()
+        if errors:
+            GtkUtil.show_dialog("Import Error", "\n".join(errors))
+        return False
 
     def update(self):
         self.emit("refresh-sources")
-        self.model.populate_data()
+        self.refresh_tree()
+        self.rank_texts()
 
+    def refresh_tree(self):
+        """
+        Reload the sources tree now if it is shown, otherwise once it is next shown
+        """
+        self.tree_stale = not self.get_mapped()
+        if not self.tree_stale:
+            self.model.populate_data()
 
     def add_texts(self, source, texts, lesson=None, update=True):
+        """
+        Add texts to the named source, returning how many were new
+        """
         idx = DB.get_source(source, lesson)
-        out = []
-        for text in texts:
-            hasher = hashlib.sha1()
-            hasher.update(text.encode("utf-8"))
-            text_hash = hasher.hexdigest()
-            dis = 1 if lesson == 2 else None
-            try:
-                DB.execute("insert into text (id,text,source,disabled) values (?,?,?,?)",
-                           (text_hash, text, idx, dis))
-                out.append(text_hash)
-            except Exception:
-                # TODO properly handle exception
-                pass # silently skip ...
+        dis = 1 if lesson == 2 else None
+        added = DB.add_texts(idx, [(text_hash(text), text) for text in texts], dis)
         if update:
             self.update()
         if lesson:
             DB.commit()
-        return out
+        return added
 
     def new_review(self, review):
-        added = self.add_texts("<Reviews>", [review], lesson=2, update=False)
-        if added:
+        if self.add_texts("<Reviews>", [review], lesson=2, update=False):
             tgt = DB.fetchone("select id,source,text from text where id = ?",
-                              self.default_text, added)
+                              self.default_text, (text_hash(review), ))
             self.emit("set-text", *tgt)
         else:
             self.next_text()
 
     def next_text(self):
         kind = Settings.get("select_method")
-        if kind != 1:
-            # Not in order
-            targets = DB.execute(
-                f"""select id,source,text from text where disabled is null
-                order by random() limit {Settings.get("num_rand")}""").fetchall()
-            if not targets:
-                target = None
-            elif kind == 2:
-                target = min(targets, key=self.diff_eval)
-            elif kind == 3:
-                target = max(targets, key=self.diff_eval)
-            else:
-                target = targets[0] # random, just pick the first
+        if kind in (2, 3) and self.scoring and self.ranking is not None:
+            # The slowest or fastest enabled text of the library
+            target = None
+            for text_id in reversed(self.ranking) if kind == 2 else self.ranking:
+                target = DB.fetchone("""select id,source,text from text
+                    where id = ? and disabled is null""", None, (text_id, ))
+                if target is not None:
+                    break
+        elif kind in (2, 3) and self.scoring:
+            # The slowest or fastest of a sample of texts
+            sample = Settings.get("num_rand")
+            target = DB.fetchone(f"""select id,source,text from
+                (select id,source,text,text_time(text) as time from
+                    (select id,source,text from text where disabled is null
+                        order by random() limit ?))
+                where time is not null
+                order by time {"desc" if kind == 2 else "asc"} limit 1""", None,
+                                 (sample if sample > 0 else self.rank_sample, ))
+        elif kind != 1:
+            # Random
+            target = DB.fetchone("""select id,source,text from text where disabled is null
+                order by random() limit 1""", None)
         else:
             # Fetch in order
             prev = (0,)
@@ -240,41 +399,53 @@ class TextManager(GtkUtil.AmphBoxLayout):
 
     def enable_all(self):
         DB.execute('update text set disabled = null where disabled is not null')
-        self.update()
         DB.commit()
+        for s_row in self.model:
+            if s_row[2]:
+                s_row[5] = "No"
+            for t_row in s_row.iterchildren():
+                t_row[5] = "No"
 
     def delete_disabled(self):
+        removed = dict(DB.fetchall(
+            "select source,count(*) from text where disabled is not null group by source"))
         DB.execute('delete from text where disabled is not null')
+        # sources left without texts are deleted, or only disabled if they have results
         DB.execute("""
-            delete from source where rowid in (
-                select s.rowid from source as s
-                    left join result as r on (s.rowid=r.source)
-                    left join text as t on (t.source=s.rowid)
-                group by s.rowid
-                having count(r.rowid) = 0 and count(t.rowid) = 0
-            )""")
+            delete from source where rowid not in (select source from text)
+                and rowid not in (select source from result)""")
         DB.execute("""
-            update source set disabled = 1 where rowid in (
-                select s.rowid from source as s
-                    left join result as r on (s.rowid=r.source)
-                    left join text as t on (t.source=s.rowid)
-                group by s.rowid
-                having count(r.rowid) > 0 and count(t.rowid) = 0
-            )""")
-        self.emit("refresh-sources")
-        self.update()
+            update source set disabled = 1
+                where disabled is null and rowid not in (select source from text)""")
         DB.commit()
 
+        # paths in tree order, so removing them back to front keeps the rest valid
+        stale = []
+        for s_row in self.model:
+            count = (s_row[2] or 0) - removed.get(s_row[0], 0)
+            if count <= 0:
+                stale.append(s_row.path)
+                continue
+            s_row[2] = count
+            s_row[5] = "No"
+            stale.extend(t_row.path for t_row in s_row.iterchildren() if t_row[5] == "Yes")
+        for tree_path in reversed(stale):
+            self.model.remove(self.model.get_iter(tree_path))
+        self.emit("refresh-sources")
+
     def toggle_selected(self):
         model, paths = self.tree.get_selection().get_selected_rows()
-        for path in paths:
-            if model.iter_depth(model.get_iter(path)) == 0:
-                continue
+        texts = [model.get_iter(path) for path in paths if path.get_depth() == 2]
+        texts = [t_iter for t_iter in texts if model[t_iter][0] != SourceModel.placeholder[0]]
+        if not texts:
+            return
 
-            row = Gtk.TreeModelRow(model, path)
-            DB.execute("update text set disabled = 1 where rowid=?", (row[0], ))
-        self.update()
+        DB.execute("update text set disabled = 1 where rowid in (select value from json_each(?))",
+                   (json.dumps([model[t_iter][0] for t_iter in texts]), ))
         DB.commit()
+        for t_iter in texts:
+            model[t_iter][5] = "Yes"
+        model.update_sources([model.iter_parent(t_iter) for t_iter in texts])
 
     def double_clicked(self, treeview, where, _column):
         model = treeview.get_model()
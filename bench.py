@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmarks for the hot paths of Amphetype.
+
+Run with the name of a benchmark, e.g. `./bench.py median`, or without
+arguments to list them.
+"""
+
+import argparse
+import bisect
+import collections
+import glob
+import math
+import random
+import re
+import time
+
+import Data
+from Data import MedianAggregate, ApproxMedianAggregate
+import Miner
+import Quizzer
+import Performance
+
+BENCHMARKS = {}
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print(f"{label:>24}: {time.perf_counter() - start:8.3f}s")
+    return result
+
+def memory_db():
+    return Data.connect(":memory:")
+
+def synthetic_statistics(db, rows, items=2000):
+    rand = random.Random(1)
+    db.executemany("""insert into statistic (w, data, type, time, count, mistakes, viscosity)
+        values (?,?,?,?,?,?,?)""",
+                   ((rand.uniform(0, 1e8), f"i{rand.randrange(items)}", rand.randrange(3),
+                     rand.lognormvariate(-2, 0.5), 1, rand.random() < 0.05, rand.random())
+                    for _ in range(rows)))
+    db.commit()
+
+class LegacyMedianAggregate(list):
+    """
+    The original insort-based median aggregate, kept for comparison
+    """
+    def step(self, val):
+        bisect.insort(self, val)
+
+    def finalize(self):
+        length = len(self)
+        if length & 1:
+            return self[length // 2]
+        return (self[length//2] + self[length//2-1])/2.0
+
+@benchmark
+def median(args):
+    """
+    agg_median over synthetic statistic tables, with groups below and above exact_limit
+    """
+    large = max(1, args.rows // (4 * ApproxMedianAggregate.exact_limit))
+    for items in (args.items, large):
+        print(f"{items} groups of ~{args.rows // items} values:")
+        db = memory_db()
+        timed(f"insert {args.rows} rows", synthetic_statistics, db, args.rows, items)
+
+        sql = "select data,{}(time) from statistic group by data order by data"
+        results = {}
+        for name, agg in [("legacy", LegacyMedianAggregate),
+                          ("exact", MedianAggregate),
+                          ("approximate", ApproxMedianAggregate)]:
+            db.create_aggregate(f"agg_{name}", 1, agg)
+            results[name] = timed(name, db.fetchall, sql.format(f"agg_{name}"))
+
+        assert results["exact"] == results["legacy"], "exact median differs from legacy"
+        error = max(abs(a[1] - e[1]) / e[1]
+                    for a, e in zip(results["approximate"], results["exact"]))
+        print(f"{'max relative error':>24}: {100 * error:8.3f}%")
+
+@benchmark
+def rollup(args):
+    """
+    Analysis query over statistic compared with statistic_rollup
+    """
+    db = memory_db()
+    timed(f"insert {args.rows} rows", synthetic_statistics, db, args.rows, args.items)
+    timed("rebuild rollup", db.rebuild_rollup)
+
+    since = 5e7
+    sql = """select data,agg_median(time),agg_median(viscosity),sum(count),sum(mistakes)
+        from (%s) group by data"""
+    source, source_args = db.statistic_source(1, since)
+    timed("statistic", db.fetchall,
+          sql % "select * from statistic where type = ? and w >= ?", (1, since))
+    timed("rollup", db.fetchall, sql % source, source_args)
+    assert timed("check", db.check_rollup, since), "rollup differs from statistic"
+
+class LegacySentenceSplitter():
+    """
+    The original SentenceSplitter, kept for comparison
+    """
+    def __init__(self, text):
+        self.string = text
+
+    def __iter__(self):
+        parts = [0]
+        sentence = r"""(?:(?: |^)[^\w. ]*(?P<pre>\w+)[^ .]*\.+|[?!]+)['"]?(?= +(?:[^ a-z]|$))|$"""
+        sen_re = re.compile(sentence)
+        return filter(None, [self.pars(parts, x) for x in sen_re.finditer(self.string)])
+
+    def pars(self, parts, mat):
+        is_abbr = lambda s: s.lower() in abbreviations or s in abbreviations
+        if mat.group('pre') and is_abbr(mat.group('pre')):
+            return None
+        parts.append(mat.end())
+        return self.string[parts[-2]:parts[-1]].strip()
+
+abbreviations = Miner.abbreviations
+
+@benchmark
+def splitter(args):
+    """
+    Sentence splitting throughput over the bundled txt/ corpus
+    """
+    files = sorted(glob.glob("txt/*.txt"))
+    paras = []
+    for fname in files:
+        with open(fname, encoding="utf_8_sig") as file:
+            paras.extend(split.string for split in Miner.LessonMiner(fname, 0).get_paras(file))
+    size = sum(len(par.encode("utf-8")) for par in paras) / 1e6
+
+    for name, splitter_class in [("legacy", LegacySentenceSplitter),
+                                 ("current", Miner.SentenceSplitter)]:
+        runs = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for par in paras:
+                for _ in splitter_class(par):
+                    pass
+            runs.append(time.perf_counter() - start)
+        best, worst = min(runs), max(runs)
+        print(f"{name:>24}: {best:8.3f}s {size / best:8.2f} MB/s"
+              f" (best of {args.repeat}, worst {size / worst:.2f} MB/s)")
+
+    current = Miner.SentenceSplitter
+    for fname in files:
+        lessons = list(Miner.LessonMiner(fname, 220))
+        Miner.SentenceSplitter = LegacySentenceSplitter
+        try:
+            legacy = list(Miner.LessonMiner(fname, 220))
+        finally:
+            Miner.SentenceSplitter = current
+        assert lessons == legacy, f"lessons of {fname} differ from legacy splitter"
+    print(f"{'lessons':>24}: identical for {len(files)} files")
+
+    rand = random.Random(1)
+    pieces = ["a", "A", "1", "é", "_", ".", ".", "?", "!", "'", '"', " ", " ", "(", ",",
+              "Mr", "etc", "e.g", "\n"]
+    for _ in range(100000):
+        par = "".join(rand.choice(pieces) for _ in range(rand.randrange(25)))
+        assert list(Miner.SentenceSplitter(par)) == list(LegacySentenceSplitter(par)), \
+            f"sentences of {par!r} differ from legacy splitter"
+    print(f"{'random paragraphs':>24}: identical for 100000")
+
+class LegacyStatistic(list):
+    """
+    The original Statistic of Data.py, kept for legacy_extract_statistics
+    """
+    def __init__(self):
+        super(LegacyStatistic, self).__init__()
+        self.flawed_ = 0
+
+    def append(self, x, flawed=False):
+        bisect.insort(self, x)
+        if flawed:
+            self.flawed_ += 1
+
+    def median(self):
+        length = len(self)
+        if length == 0:
+            return None
+        if length & 1:
+            return self[length // 2]
+        return (self[length//2] + self[length//2-1])/2.0
+
+    def flawed(self):
+        return self.flawed_
+
+def legacy_extract_statistics(text, times, mis, spc, now):
+    """
+    The original Quizzer.done statistics extraction, kept for comparison
+    """
+    stats = collections.defaultdict(LegacyStatistic)
+    viscs = collections.defaultdict(LegacyStatistic)
+
+    for char, time, mistake in zip(text, times, mis):
+        stats[char].append(time, mistake)
+        viscs[char].append((time/spc - 1)**2)
+
+    def gen_tup(start, end):
+        span = end - start
+        char_avg = sum(times[start:end]) / span
+        visc = sum((t/char_avg - 1)**2 for t in times[start:end]) / span
+        return (text[start:end], char_avg, sum(1 for f in mis[start:end] if f), visc)
+
+    for trigraph, time, mist, visc in [gen_tup(i, i+3) for i in range(0, len(text) - 2)]:
+        stats[trigraph].append(time, mist > 0)
+        viscs[trigraph].append(visc)
+
+    regex = re.compile(r"(\w|'(?![A-Z]))+(-\w(\w|')*)*")
+    for word, time, mist, visc in [
+            gen_tup(*m.span()) for m in regex.finditer(text) if m.end() - m.start() > 3]:
+        stats[word].append(time, mist > 0)
+        viscs[word].append(visc)
+
+    def kind(key):
+        if len(key) == 1:
+            return 0
+        if len(key) == 3:
+            return 1
+        return 2
+
+    vals = []
+    for key, stat in stats.items():
+        visc = viscs[key].median()
+        vals.append((stat.median(), visc*100.0, now, len(stat), stat.flawed(), kind(key), key))
+    return vals
+
+@benchmark
+def extract(args):
+    """
+    Statistics extraction of Quizzer.done on long texts, compared with the original
+    """
+    rand = random.Random(1)
+    with open("txt/Fairy Tales of Hans Christian Andersen.txt", encoding="utf_8_sig") as file:
+        words = file.read().split()
+    for length in (600, 6000, 60000):
+        start = rand.randrange(len(words) - length)
+        text = " ".join(words[start:start + length])[:length]
+        times = [rand.lognormvariate(-2, 0.5) for _ in text]
+        mis = [rand.random() < 0.03 for _ in text]
+        spc = sum(times) / len(text)
+
+        print(f"{length} characters")
+        legacy = timed("legacy", legacy_extract_statistics, text, times, mis, spc, 0.0)
+        current = timed("current", Quizzer.extract_statistics, text, times, mis, spc, 0.0)
+
+        assert len(legacy) == len(current), "different number of statistics"
+        for old, new in zip(legacy, current):
+            assert old[2:] == new[2:], f"{old} differs from {new}"
+            assert all(math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9)
+                       for a, b in zip(old[:2], new[:2])), f"{old} differs from {new}"
+
+def synthetic_results(db, rows):
+    rand = random.Random(1)
+    when = 0.0
+    results = []
+    for _ in range(rows):
+        # mostly texts in quick succession, with the odd break between sittings
+        when += rand.choice((30.0, 60.0, 120.0, 3600.0, 86400.0))
+        results.append((when, f"t{rand.randrange(1000)}", rand.randrange(1, 10),
+                        rand.uniform(20, 120), rand.random(), rand.random()))
+    db.executemany("""insert into result (w, text_id, source, wpm, accuracy, viscosity)
+        values (?,?,?,?,?,?)""", results)
+    db.commit()
+
+class LegacyGroups():
+    """
+    The original counter() and time_group() functions used to group the history
+    """
+    def __init__(self):
+        self.count = -1
+        self.lasttime = 0.0
+        self.timecnt = 0
+
+    def counter(self):
+        self.count += 1
+        return self.count
+
+    def time_group(self, interval, ltime):
+        if abs(ltime - self.lasttime) >= interval:
+            self.timecnt += 1
+        self.lasttime = ltime
+        return self.timecnt
+
+def legacy_history(db, groupby, size, mis, limit):
+    groups = LegacyGroups()
+    db.create_function("counter", 0, groups.counter)
+    db.create_function("time_group", 2, groups.time_group)
+    group = ["", f"group by cast(counter()/{size} as int)",
+             f"group by time_group({mis}, r.w)"][groupby]
+    return db.fetchall(f"""select agg_first(text_id),avg(r.w) as w,count(r.rowid)
+            || ' result(s)',agg_median(r.wpm),
+            100.0*agg_median(r.accuracy),agg_median(r.viscosity)
+        from result as r left join source as s on (r.source = s.rowid)
+        {group}
+        order by w desc limit {limit}""")
+
+@benchmark
+def history(args):
+    """
+    Grouped Performance history, with window functions and with the original UDFs
+    """
+    db = memory_db()
+    timed(f"insert {args.results} results", synthetic_results, db, args.results)
+    size = max(Performance.Settings.get("def_group_by"), 1)
+    mis = Performance.Settings.get("minutes_in_sitting") * 60.0
+
+    for groupby, name in [(1, "sessions"), (2, "sitting")]:
+        for limit in (100, args.results):
+            print(f"{name}, {limit} rows")
+            legacy = timed("legacy", legacy_history, db, groupby, size, mis, limit)
+            sql, sql_args = Performance.history_sql([], groupby)
+            current = timed("window", db.fetchall, sql,
+                            dict(sql_args, start=float("inf"), limit=limit))
+            if groupby == 1:
+                # the legacy groups count from whichever end SQLite scanned first
+                whens = [w for w, in db.fetchall("select w from result order by w desc")]
+                legacy = [(None, sum(chunk) / len(chunk), f"{len(chunk)} result(s)")
+                          for chunk in (whens[i:i + size] for i in range(0, len(whens), size))]
+                legacy = legacy[:limit]
+            assert [row[1:3] for row in legacy] == [row[1:3] for row in current], \
+                f"{name} groups differ from legacy"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("name", nargs="?", choices=list(BENCHMARKS))
+    parser.add_argument("--rows", type=int, default=1000000,
+                        help="size of synthetic tables")
+    parser.add_argument("--items", type=int, default=2000,
+                        help="number of distinct keys/trigrams/words in synthetic tables")
+    parser.add_argument("--results", type=int, default=100000,
+                        help="size of synthetic result tables")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs of the splitter benchmark, of which the best is reported")
+    args = parser.parse_args()
+
+    if args.name is None:
+        for name, func in BENCHMARKS.items():
+            print(f"{name}: {func.__doc__.strip()}")
+        return
+    BENCHMARKS[args.name](args)
+
+if __name__ == "__main__":
+    main()